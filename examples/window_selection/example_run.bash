@@ -6,6 +6,8 @@
 # cores since every core will write large figure files.
 # Since the test file only contains 4 stream, please
 # the numproc=2 and do not change it.
+# Multiple path files(one for each event) could be given after "-f",
+# so the param file is only parsed once for all the events.
 mpiexec -n 2 pypaw-window_selection_asdf \
   -p ./parfile/window.param.yml \
   -f ./parfile/window.path.json \
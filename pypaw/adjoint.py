@@ -15,10 +15,15 @@ import inspect
 import pyadjoint
 from pyasdf import ASDFDataSet
 from pytomo3d.adjoint import calculate_and_process_adjsrc_on_stream
+from pytomo3d.adjoint.adjsrc import calculate_adjsrc_on_stream
 from pytomo3d.adjoint.process_adjsrc import process_adjoint
-from pytomo3d.adjoint.utils import reshape_adj
+from pytomo3d.adjoint.utils import calculate_chan_weight, reshape_adj
 from .procbase import ProcASDFBase
-from .utils import smart_read_json
+from .utils import smart_read_json, dump_json, tree_reduce, shard_filename, \
+    merge_json_shards
+from .multitaper import dpss_cache_installed, merge_dpss_cache_stats, \
+    report_dpss_cache_stats
+from .figure import make_plot_payload, dump_plot_payload, render_figures
 
 
 def check_process_config_keywords(config):
@@ -72,12 +77,85 @@ def load_adjoint_config(config, adjsrc_type):
     return ConfigClass(**config)
 
 
+def write_measurements(content, filename):
+    content_filter = dict(
+        (k, v) for k, v in content.iteritems() if v is not None)
+    dump_json(content_filter, filename)
+
+
+def get_interp_starttime(event):
+    """
+    Starttime of the adjoint sources, set as cmt_time - 1.5 * hdur
+    to fit the SPECFEM behaviour
+    """
+    origin = event.preferred_origin() or event.origins[0]
+    focal = event.preferred_focal_mechanism() or event.focal_mechanisms[0]
+    hdur = focal.moment_tensor.source_time_function.duration / 2.0
+    return origin.time - 1.5 * hdur
+
+
+def count_station_windows(window_sta):
+    """ Total number of windows on one station """
+    if not window_sta:
+        return 0
+    return sum([len(_w) for _w in window_sta.itervalues()])
+
+
+def extract_measurements(adjsrcs):
+    """
+    Extract the window measurements carried by the adjoint sources,
+    keyed by the observed trace id, in the same layout as the output
+    of measure_adjoint_on_stream
+    """
+    measurements = {}
+    for adj in adjsrcs:
+        trace_id = "%s.%s.%s.%s" % (adj.network, adj.station, adj.location,
+                                    adj.component)
+        measurements[trace_id] = adj.measurement
+    return measurements
+
+
+def calculate_adjsrc_and_measurements(
+        observed, synthetic, windows, inventory, config, event,
+        adj_src_type, postproc_param, figure_mode=False, figure_dir=None,
+        adjoint_src_flag=True):
+    """
+    Calculate the adjoint sources and keep the adjoint sources before
+    post-processing, which carry the measurements and are still on the
+    components of the windows(before rotation). It makes the same
+    calls as pytomo3d's calculate_and_process_adjsrc_on_stream, which
+    only returns the processed adjoint sources.
+
+    :return: (processed adjoint sources, adjoint sources before
+        post-processing). (None, None) if there is no window.
+    """
+    if count_station_windows(windows) == 0:
+        return None, None
+
+    adjsrcs = calculate_adjsrc_on_stream(
+        observed, synthetic, windows, config, adj_src_type,
+        figure_mode=figure_mode, figure_dir=figure_dir,
+        adjoint_src_flag=adjoint_src_flag)
+
+    if postproc_param["weight_flag"]:
+        chan_weight_dict = calculate_chan_weight(adjsrcs, windows)
+    else:
+        chan_weight_dict = None
+
+    new_adjsrcs = process_adjoint(
+        adjsrcs, interp_starttime=get_interp_starttime(event),
+        inventory=inventory, event=event, weight_dict=chan_weight_dict,
+        **postproc_param)
+    return new_adjsrcs, adjsrcs
+
+
 def adjoint_wrapper(obsd_station_group, synt_station_group, config=None,
                     obsd_tag=None, synt_tag=None, windows=None, event=None,
                     adj_src_type="multitaper_misfit",
                     postproc_param=None,
                     figure_mode=False, figure_dir=False,
-                    adjoint_src_flag=True):
+                    figure_deferred=True, adjoint_src_flag=True,
+                    measurements=None):
 
     """
     Function wrapper for pyasdf.
@@ -109,12 +187,25 @@ def adjoint_wrapper(obsd_station_group, synt_station_group, config=None,
     :param adjoint_src_flag: calcualte adjoint source, put this to true.
         If false, only make measurements but no adjoint sources.
     :type adjoint_src_flag: bool
-    :param figure_mode: plot figures for adjoint source or not
+    :param figure_mode: plot figures for adjoint source or not. The
+        plot payload is dumped into figure_dir and rendered later
     :type figure_mode: bool
     :param figure_dir: output figure directory
     :type figure_dir: str
+    :param figure_deferred: if False, the pyadjoint figures are plotted
+        during the calculation instead of rendered later
+    :type figure_deferred: bool
+    :param measurements: if not None, the measurements of this station
+        are also stored into this dict, keyed by station name
+    :type measurements: dict
     :return: adjoint sources for pyasdf write out(reshaped)
     """
+    # stations without windows(including stations whose channels all
+    # have empty window lists) are skipped before reading any data
+    window_sta = windows.get(obsd_station_group._station_name)
+    if count_station_windows(window_sta) == 0:
+        return
+
     # Make sure everything thats required is there.
     if not hasattr(obsd_station_group, obsd_tag):
         print("Missing tag '%s' from obsd_station_group %s. Skipped." %
@@ -126,21 +217,37 @@ def adjoint_wrapper(obsd_station_group, synt_station_group, config=None,
         return
     if not hasattr(obsd_station_group, "StationXML"):
         print("Missing tag 'STATIONXML' from obsd_station_group %s. Skipped" %
-              (obsd_tag, obsd_station_group._station_name))
-
-    try:
-        window_sta = windows[obsd_station_group._station_name]
-    except:
+              obsd_station_group._station_name)
         return
 
     observed = getattr(obsd_station_group, obsd_tag)
     synthetic = getattr(synt_station_group, synt_tag)
     obsd_staxml = getattr(obsd_station_group, "StationXML")
 
-    adjsrcs = calculate_and_process_adjsrc_on_stream(
-        observed, synthetic, window_sta, obsd_staxml, config, event,
-        adj_src_type, postproc_param,
-        figure_mode=figure_mode, figure_dir=figure_dir)
+    inline_figure = figure_mode and not figure_deferred
+    deferred_figure = figure_mode and figure_deferred
+    if measurements is not None or deferred_figure:
+        adjsrcs, raw_adjsrcs = calculate_adjsrc_and_measurements(
+            observed, synthetic, window_sta, obsd_staxml, config, event,
+            adj_src_type, postproc_param, figure_mode=inline_figure,
+            figure_dir=figure_dir, adjoint_src_flag=adjoint_src_flag)
+        if measurements is not None:
+            measurements[obsd_station_group._station_name] = \
+                extract_measurements(raw_adjsrcs)
+    else:
+        adjsrcs = calculate_and_process_adjsrc_on_stream(
+            observed, synthetic, window_sta, obsd_staxml, config, event,
+            adj_src_type, postproc_param,
+            figure_mode=inline_figure, figure_dir=figure_dir)
+
+    if deferred_figure:
+        # figures are rendered after all stations are processed. The
+        # adjoint sources before rotation are used, so they are on the
+        # same components as the windows
+        payload = make_plot_payload(observed, synthetic, window_sta,
+                                    adjsrcs=raw_adjsrcs)
+        dump_plot_payload(figure_dir, obsd_station_group._station_name,
+                          payload)
 
     _final = reshape_adj(adjsrcs, obsd_staxml)
 
@@ -204,6 +311,21 @@ class AdjointASDF(ProcASDFBase):
         return smart_read_json(winfile, mpi_mode=self.mpi_mode,
                                object_hook=False)
 
+    @staticmethod
+    def get_window_stations(windows):
+        """
+        Get the stations which have at least one window
+
+        :param windows: windows loaded from the window file
+        :type windows: dict
+        :return: sorted list of station names
+        """
+        stations = []
+        for sta, sta_win in windows.iteritems():
+            if count_station_windows(sta_win) > 0:
+                stations.append(sta)
+        return sorted(stations)
+
     def _core(self, path, param):
         """
         Core function that handles one pair of asdf file(observed and
@@ -224,11 +346,16 @@ class AdjointASDF(ProcASDFBase):
         synt_file = path["synt_asdf"]
         window_file = path["window_file"]
         output_filename = path["output_file"]
+        # if provided, the measurements are also written out into this
+        # file in the same pass
+        measure_filename = path.get("measure_file", None)
 
         self.check_input_file(obsd_file)
         self.check_input_file(synt_file)
         self.check_input_file(window_file)
         self.check_output_file(output_filename)
+        if measure_filename is not None:
+            self.check_output_file(measure_filename)
 
         obsd_ds = self.load_asdf(obsd_file, mode="r")
         obsd_tag = path["obsd_tag"]
@@ -236,9 +363,14 @@ class AdjointASDF(ProcASDFBase):
         synt_tag = path["synt_tag"]
         figure_mode = path["figure_mode"]
         figure_dir = path["figure_dir"]
+        # if False, the pyadjoint figures are plotted during calculation
+        figure_deferred = path.get("figure_deferred", True)
 
         event = obsd_ds.events[0]
         windows = self.load_windows(window_file)
+        if self.rank == 0:
+            print("Number of stations with windows: %d"
+                  % len(self.get_window_stations(windows)))
 
         adj_src_type = adjoint_param["adj_src_type"]
         adjoint_param.pop("adj_src_type", None)
@@ -254,14 +386,49 @@ class AdjointASDF(ProcASDFBase):
         if self.mpi_mode:
             self.comm.barrier()
 
+        # measurements are collected on each rank
+        measurements = {} if measure_filename is not None else None
+
         adjsrc_func = \
             partial(adjoint_wrapper, config=config,
                     obsd_tag=obsd_tag, synt_tag=synt_tag,
                     windows=windows, event=event,
                     adj_src_type=adj_src_type,
                     postproc_param=postproc_param,
-                    figure_mode=figure_mode, figure_dir=figure_dir)
+                    figure_mode=figure_mode, figure_dir=figure_dir,
+                    figure_deferred=figure_deferred,
+                    measurements=measurements)
+
+        with dpss_cache_installed() as dpss_cache:
+            results = obsd_ds.process_two_files(synt_ds, adjsrc_func,
+                                                output_filename)
+        dpss_stats = tree_reduce(dpss_cache.stats(), merge_dpss_cache_stats,
+                                 comm=self.comm)
+        if self.rank == 0:
+            report_dpss_cache_stats(dpss_stats)
+
+        if measure_filename is not None:
+            self.write_measurements_sharded(measurements, measure_filename)
+
+        if figure_mode and figure_deferred:
+            render_figures(figure_dir, comm=self.comm)
 
-        results = obsd_ds.process_two_files(synt_ds, adjsrc_func,
-                                            output_filename)
         return results
+
+    def write_measurements_sharded(self, measurements, filename):
+        """
+        Each rank writes its own measurements into a shard, which are
+        then merged into filename on rank 0
+        """
+        write_measurements(measurements, shard_filename(filename, self.rank))
+        nstations = tree_reduce(
+            len([v for v in measurements.itervalues() if v is not None]),
+            lambda a, b: a + b, comm=self.comm)
+        self.comm.barrier()
+
+        if self.rank == 0:
+            print("Number of stations with measurements: %d" % nstations)
+            print("output filename: %s" % filename)
+            shard_files = [shard_filename(filename, _i)
+                           for _i in range(self.comm.Get_size())]
+            merge_json_shards(shard_files, filename)
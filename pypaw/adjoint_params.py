@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fast access to the adjoint sources in asdf file through h5py. The
+parameters are read from the HDF5 attributes only, without building
+the pyasdf auxiliary data objects or loading the data arrays.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import h5py
+import numpy as np
+
+
+ADJOINT_GROUP = "AuxiliaryData/AdjointSources"
+
+
+def _to_python(value):
+    """ numpy scalars to python types, so they could be dumped to json """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _read_attrs(dataset):
+    return dict((key, _to_python(value))
+                for key, value in dataset.attrs.iteritems())
+
+
+def read_adjoint_parameters(asdf_file, names=None):
+    """
+    Read the parameters of adjoint sources, from attributes only
+
+    :param names: names of adjoint sources to read, like "II_AAK_MXZ".
+        If None, all adjoint sources are read.
+    :return: {name: parameters}. Empty if there is no adjoint source
+        group in the file.
+    """
+    with h5py.File(asdf_file, 'r') as fh:
+        if ADJOINT_GROUP not in fh:
+            return {}
+        group = fh[ADJOINT_GROUP]
+        if names is None:
+            names = [_n for _n, _d in group.iteritems()
+                     if isinstance(_d, h5py.Dataset)]
+        return dict((name, _read_attrs(group[name])) for name in names
+                    if name in group)
+
+
+class AdjointSourceRecord(object):
+    """
+    Stand-in of pyasdf auxiliary data for one adjoint source, with
+    parameters read in bulk and data only read on access
+    """
+    def __init__(self, fh, name, parameters):
+        self._fh = fh
+        self.path = name
+        self.parameters = parameters
+
+    @property
+    def data(self):
+        return self._fh[ADJOINT_GROUP][self.path][()]
+
+
+class AdjointSourceReader(object):
+    """
+    Dict-like access to the adjoint sources in an asdf file, like
+    ds.auxiliary_data.AdjointSources. The parameters of all adjoint
+    sources are read when opened.
+
+    >>> with AdjointSourceReader("adjoint.h5") as adjsrcs:
+    ...     adj = adjsrcs["II_AAK_MXZ"]
+    """
+    def __init__(self, asdf_file):
+        self._fh = h5py.File(asdf_file, 'r')
+        if ADJOINT_GROUP in self._fh:
+            group = self._fh[ADJOINT_GROUP]
+            self.parameters = dict(
+                (_n, _read_attrs(_d)) for _n, _d in group.iteritems()
+                if isinstance(_d, h5py.Dataset))
+        else:
+            self.parameters = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._fh.close()
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def __contains__(self, name):
+        return name in self.parameters
+
+    def __getitem__(self, name):
+        return AdjointSourceRecord(self._fh, name, self.parameters[name])
+
+    def list(self):
+        return sorted(self.parameters.keys())
@@ -7,7 +7,7 @@ from __future__ import (print_function, division)
 import os
 import json
 import argparse
-from pyasdf import ASDFDataSet
+from pypaw.adjoint_params import read_adjoint_parameters
 
 
 def extract_adjoint_misfit(asdf_file, verbose):
@@ -16,27 +16,26 @@ def extract_adjoint_misfit(asdf_file, verbose):
 
     if not os.path.exists(asdf_file):
         raise ValueError("ASDF file not exists: %s" % asdf_file)
-    ds = ASDFDataSet(asdf_file, mode='r')
-    try:
-        adjsrc_group = ds.auxiliary_data.AdjointSources
-    except Exception as err:
-        raise ValueError("Can not get adjoint misfit information(due to %s). "
+    # only the attributes are read, no data arrays
+    all_parameters = read_adjoint_parameters(asdf_file)
+    if len(all_parameters) == 0:
+        raise ValueError("Can not get adjoint misfit information. "
                          "Check if the adjoint source group exists in the "
-                         "file" % err)
+                         "file")
 
     nadj = 0
     nadj_cat = {}
     misfit_cat = {}
     misfit_dict = {}
-    for adj in adjsrc_group:
+    for parameters in all_parameters.itervalues():
         nadj += 1
 
-        nw = adj.parameters["station_id"].split(".")[0]
-        sta = adj.parameters["station_id"].split(".")[1]
-        comp = adj.parameters["component"]
-        loc = adj.parameters["location"]
+        nw = parameters["station_id"].split(".")[0]
+        sta = parameters["station_id"].split(".")[1]
+        comp = parameters["component"]
+        loc = parameters["location"]
         station_id = "%s.%s.%s.%s" % (nw, sta, loc, comp)
-        misfit = adj.parameters["misfit"]
+        misfit = parameters["misfit"]
 
         misfit_dict[station_id] = misfit
         if comp not in misfit_cat:
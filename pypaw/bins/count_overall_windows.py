@@ -9,25 +9,70 @@ stage.
 If "weight_output_file" is in the path file, then a default weight param
 file will also be generated. Be sure to modify some values and then it can
 be used in the weighting stage.
+
+With "--cache-dir", window counts of each window file are cached
+in that directory(see pypaw.window_counts), so running it again only
+parses the window files modified since. Nothing is cached by default.
+
+Window files could be counted by a process pool("-n nprocs"), and
+with "--fast", window counts are scanned from the raw text of window
+files, without loading them as json.
+
+The window files of each event(with their modification time and size)
+are kept in a cache file(path["cache_file"], default as
+"<output_file>.cache.json"). With "--incremental", the previous output
+file is updated: events removed from the path file are removed, new
+events and events whose window files changed are counted, and the
+other events are kept as they are, without reading their window files.
 """
 from __future__ import print_function, division, absolute_import
+import os
 import numpy as np
 import argparse
+from multiprocessing import Pool
 from pprint import pprint
-from pytomo3d.window.utils import generate_log_content
+from pypaw.window_counts import load_window_counts, file_signature
 from .utils import load_json, load_yaml, dump_json, dump_yaml
 
 
-def stats_one_window_file(filename):
+def stats_one_window_file(filename, cache_dir=None, fast=False):
     """
     Given one window file, return the window counts for different
     component
     """
-    windows = load_json(filename)
-    log = generate_log_content(windows)
+    counts = load_window_counts(filename, cache_dir=cache_dir, fast=fast)
+    return dict(counts["cat_wcounts"])
+
+
+def _stats_one_window_file(args):
+    """ process pool worker, args as (event, period, filename, kwargs) """
+    e, p, filename, kwargs = args
+    return e, p, stats_one_window_file(filename, **kwargs)
+
+
+def stats_window_files(path, cache_dir=None, fast=False, nprocs=1):
+    """
+    Window counts of all window files, as {event: {period: results}}.
+    Window files are counted by a process pool if nprocs > 1.
+    """
+    kwargs = {"cache_dir": cache_dir, "fast": fast}
+    jobs = [(e, p, filename, kwargs)
+            for e, einfo in sorted(path["input"].iteritems())
+            for p, filename in sorted(einfo.iteritems())]
     results = {}
-    for comp in log["component"]:
-        results[comp] = log["component"][comp]["windows"]
+    if nprocs > 1 and len(jobs) > 1:
+        pool = Pool(processes=min(nprocs, len(jobs)))
+        try:
+            _iter = pool.imap_unordered(_stats_one_window_file, jobs,
+                                        chunksize=16)
+            for e, p, one_file_results in _iter:
+                results.setdefault(e, {})[p] = one_file_results
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for e, p, one_file_results in map(_stats_one_window_file, jobs):
+            results.setdefault(e, {})[p] = one_file_results
     return results
 
 
@@ -47,6 +92,20 @@ def update_overall_wcounts(overall_wcounts, period, one_file_results):
         overall_wcounts[period][comp] += one_file_results[comp]
 
 
+def collect_overall_wcounts(detailed_event_windows):
+    """
+    Overall window counts from the detailed information of all events,
+    the same as updated event by event
+    """
+    overall_wcounts = {}
+    for e in sorted(detailed_event_windows):
+        for p, one_file_results in detailed_event_windows[e].iteritems():
+            if p == "total":
+                continue
+            update_overall_wcounts(overall_wcounts, p, one_file_results)
+    return overall_wcounts
+
+
 def _validate_ratio(overall_wcounts, ratio):
     prods = []
     for p, pinfo in overall_wcounts.iteritems():
@@ -97,42 +156,122 @@ def ensemble_default_weight_param_file(overall_wcounts, param, outputfile):
     dump_yaml(default_content, outputfile)
 
 
-def stats_all_window_file(path, _verbose):
+def get_cache_file(path):
+    return path.get("cache_file", path["output_file"] + ".cache.json")
+
+
+def event_file_signatures(event_input):
+    """ window files of one event, as {period: signature} """
+    signatures = {}
+    for p, filename in event_input.iteritems():
+        signatures[p] = file_signature(filename)
+        signatures[p]["window_file"] = filename
+    return signatures
+
+
+def add_event_windows(detailed_event_windows, overall_wcounts, e,
+                      event_results):
+    """
+    Add the window counts of one event({period: results}) into the
+    detailed information and overall window counts
+    """
+    detailed_event_windows[e] = {}
+    event_total = 0
+    for p in sorted(event_results):
+        one_file_results = event_results[p]
+        print("period[%s]: %s" % (p, one_file_results))
+        detailed_event_windows[e][p] = one_file_results
+        period_total = 0
+        for comp, comp_counts in one_file_results.iteritems():
+            period_total += comp_counts
+        detailed_event_windows[e][p]["total"] = period_total
+        event_total += period_total
+        # update for overall window counts
+        update_overall_wcounts(overall_wcounts, p, one_file_results)
+    detailed_event_windows[e]["total"] = event_total
+
+
+def dump_window_stats(path, detailed_event_windows, overall_wcounts,
+                      signatures):
+    print("=" * 10 + " dump results " + "=" * 10)
+    outputfile = path["output_file"]
+    content = {"detailed_information": detailed_event_windows,
+               "summary": overall_wcounts}
+    print("outputfile: %s" % outputfile)
+    dump_json(content, outputfile)
+    dump_json(signatures, get_cache_file(path))
+
+
+def stats_all_window_file(path, _verbose, cache_dir=None, fast=False,
+                          nprocs=1):
     detailed_event_windows = {}
     overall_wcounts = {}
 
     print("=" * 10 + " Start counting windows " + "=" * 10)
+    all_results = stats_window_files(path, cache_dir=cache_dir, fast=fast,
+                                     nprocs=nprocs)
     eventlist = path["input"].keys()
     eventlist.sort()
     nevents = len(eventlist)
+    signatures = {}
     for idxe, e in enumerate(eventlist):
-        period_bands = path["input"][e].keys()
-        period_bands.sort()
         print("-" * 8 + "[%d/%d]%s" % (idxe, nevents, e) +
               "-" * 8)
-        detailed_event_windows[e] = {}
-        event_total = 0
-        for p in period_bands:
-            one_file_results = stats_one_window_file(path["input"][e][p])
-            print("period[%s]: %s" % (p, one_file_results))
-            detailed_event_windows[e][p] = one_file_results
-            period_total = 0
-            for comp, comp_counts in one_file_results.iteritems():
-                period_total += comp_counts
-            detailed_event_windows[e][p]["total"] = period_total
-            event_total += period_total
-            # update for overall window counts
-            update_overall_wcounts(overall_wcounts, p, one_file_results)
-        detailed_event_windows[e]["total"] = event_total
+        add_event_windows(detailed_event_windows, overall_wcounts, e,
+                          all_results[e])
+        signatures[e] = event_file_signatures(path["input"][e])
 
-    # dump results
-    print("=" * 10 + " dump results " + "=" * 10)
+    dump_window_stats(path, detailed_event_windows, overall_wcounts,
+                      signatures)
+    return overall_wcounts
+
+
+def update_all_window_file(path, _verbose, cache_dir=None, fast=False,
+                           nprocs=1):
+    """
+    Update the output file of a previous run, only counting the events
+    which are new or whose window files changed
+    """
     outputfile = path["output_file"]
-    content = {"detailed_information": detailed_event_windows,
-               "summary": overall_wcounts}
-    print("outputfile: %s" % outputfile)
-    dump_json(content, outputfile)
+    cache_file = get_cache_file(path)
+    if not os.path.exists(outputfile) or not os.path.exists(cache_file):
+        print("No previous results(%s, %s), count all window files"
+              % (outputfile, cache_file))
+        return stats_all_window_file(path, _verbose, cache_dir=cache_dir,
+                                     fast=fast, nprocs=nprocs)
+
+    previous = load_json(outputfile)
+    detailed_event_windows = previous["detailed_information"]
+    old_signatures = load_json(cache_file)
+
+    signatures = {}
+    for e, event_input in path["input"].iteritems():
+        signatures[e] = event_file_signatures(event_input)
+    removed = sorted(e for e in detailed_event_windows
+                     if e not in path["input"])
+    changed = sorted(e for e in path["input"]
+                     if e not in detailed_event_windows or
+                     old_signatures.get(e) != signatures[e])
+    print("Number of events removed: %d" % len(removed))
+    print("Number of events new or changed: %d" % len(changed))
+
+    for e in removed + changed:
+        detailed_event_windows.pop(e, None)
+
+    print("=" * 10 + " Start counting windows " + "=" * 10)
+    changed_path = {"input": dict((e, path["input"][e]) for e in changed)}
+    all_results = stats_window_files(changed_path, cache_dir=cache_dir,
+                                     fast=fast, nprocs=nprocs)
+    nevents = len(changed)
+    for idxe, e in enumerate(changed):
+        print("-" * 8 + "[%d/%d]%s" % (idxe, nevents, e) +
+              "-" * 8)
+        add_event_windows(detailed_event_windows, {}, e, all_results[e])
 
+    # summary is collected again, so it is the same as counting all
+    overall_wcounts = collect_overall_wcounts(detailed_event_windows)
+    dump_window_stats(path, detailed_event_windows, overall_wcounts,
+                      signatures)
     return overall_wcounts
 
 
@@ -144,6 +283,19 @@ def main():
                         required=True, help='param file')
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help='verbose flag')
+    parser.add_argument('--cache-dir', action='store', dest='cache_dir',
+                        default=None,
+                        help='directory to cache the window counts of '
+                             'each window file')
+    parser.add_argument('--fast', action='store_true', dest='fast',
+                        help='scan window counts from the raw text of '
+                             'window files, without loading the json')
+    parser.add_argument('-n', action='store', dest='nprocs', type=int,
+                        default=1, help='number of processes')
+    parser.add_argument('--incremental', action='store_true',
+                        dest='incremental',
+                        help='update the output file of the previous run, '
+                             'only counting new or changed events')
     args = parser.parse_args()
 
     path = load_json(args.path_file)
@@ -154,7 +306,13 @@ def main():
     print("=" * 10 + " Param information " + "=" * 10)
     pprint(param)
 
-    overall_wcounts = stats_all_window_file(path, args.verbose)
+    if args.incremental:
+        stats_func = update_all_window_file
+    else:
+        stats_func = stats_all_window_file
+    overall_wcounts = stats_func(
+        path, args.verbose, cache_dir=args.cache_dir, fast=args.fast,
+        nprocs=args.nprocs)
 
     if "weight_output_file" in path:
         print("weight default param file: %s" % path["weight_output_file"])
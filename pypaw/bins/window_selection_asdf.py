@@ -9,15 +9,21 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', action='store', dest='params_file',
                         required=True, help="parameter file")
-    parser.add_argument('-f', action='store', dest='path_file', required=True,
-                        help="path file")
+    parser.add_argument('-f', action='store', dest='path_files',
+                        required=True, nargs='+',
+                        help="path file(s). Multiple path files(one for "
+                             "each event) are processed in turn, with "
+                             "the param file only parsed once")
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help="verbose")
     args = parser.parse_args()
 
-    proc = WindowASDF(args.path_file, args.params_file,
-                      verbose=args.verbose)
-    proc.smart_run()
+    # window params and pyflex configs are kept in the registry and
+    # reused by the following events
+    for path_file in args.path_files:
+        proc = WindowASDF(path_file, args.params_file,
+                          verbose=args.verbose)
+        proc.smart_run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Methods that decouple figure generation from the computation. The
+compute ranks only dump lightweight plot payloads(arrays plus windows)
+to the figure directory, and the figures are rendered afterwards by all
+ranks in parallel. Matplotlib is only imported when the figures are
+rendered.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import glob
+import cPickle as pickle
+import numpy as np
+from obspy import UTCDateTime
+
+
+PAYLOAD_SUFFIX = ".plot.pkl"
+
+
+def _trace_payload(tr):
+    return {"starttime": tr.stats.starttime, "delta": tr.stats.delta,
+            "data": np.array(tr.data)}
+
+
+def _window_payload(win, starttime):
+    """
+    Transfer one window(json content) into (start, end) in seconds,
+    relative to the starttime of the trace
+    """
+    return (UTCDateTime(win["absolute_starttime"]) - starttime,
+            UTCDateTime(win["absolute_endtime"]) - starttime)
+
+
+def make_plot_payload(observed, synthetic, windows, adjsrcs=None):
+    """
+    Extract the data needed by the figures for one station
+
+    :param observed: observed stream
+    :param synthetic: synthetic stream
+    :param windows: windows on this station, keyed by the observed
+        trace id. Values are the window json content(dict)
+    :param adjsrcs: adjoint sources on this station(optional). They
+        should be the adjoint sources before post-processing(on the
+        same components as the windows, i.e., before rotation), since
+        they are matched to the observed trace by the full trace id
+    :return: the plot payload, keyed by the observed trace id
+    """
+    payload = {}
+    for trace_id, trace_win in windows.iteritems():
+        if len(trace_win) == 0:
+            continue
+        obsd = observed.select(id=trace_id)
+        synt = synthetic.select(component=trace_id[-1])
+        if len(obsd) == 0 or len(synt) == 0:
+            continue
+        obsd_tr = obsd[0]
+        payload[trace_id] = {
+            "obsd": _trace_payload(obsd_tr),
+            "synt": _trace_payload(synt[0]),
+            "windows": [_window_payload(_w, obsd_tr.stats.starttime)
+                        for _w in trace_win]}
+
+    if adjsrcs is not None:
+        for adj in adjsrcs:
+            trace_id = "%s.%s.%s.%s" % (adj.network, adj.station,
+                                        adj.location, adj.component)
+            if trace_id not in payload:
+                continue
+            payload[trace_id]["adjsrc"] = {
+                "starttime": UTCDateTime(adj.starttime),
+                "delta": adj.dt, "data": np.array(adj.adjoint_source),
+                "misfit": adj.misfit}
+    return payload
+
+
+def dump_plot_payload(figure_dir, station, payload):
+    """ dump the plot payload of one station into figure_dir """
+    if len(payload) == 0:
+        return
+    filename = os.path.join(figure_dir, "%s%s" % (station, PAYLOAD_SUFFIX))
+    with open(filename, 'wb') as fh:
+        pickle.dump(payload, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _plot_trace(ax, trace, reftime, **kwargs):
+    times = trace["starttime"] - reftime + \
+        trace["delta"] * np.arange(len(trace["data"]))
+    ax.plot(times, trace["data"], **kwargs)
+
+
+def render_one_figure(payload_file, figure_format="pdf"):
+    """
+    Render the figure from one payload file. Each trace has one row,
+    with one more row if adjoint source is in the payload.
+    """
+    import matplotlib.pyplot as plt
+    plt.switch_backend('agg')
+
+    with open(payload_file, 'rb') as fh:
+        payload = pickle.load(fh)
+
+    trace_ids = sorted(payload.keys())
+    nrows = sum([2 if "adjsrc" in payload[_id] else 1 for _id in trace_ids])
+    fig, axes = plt.subplots(nrows, 1, figsize=(12, 3 * nrows),
+                             squeeze=False)
+    idx = 0
+    for trace_id in trace_ids:
+        info = payload[trace_id]
+        reftime = info["obsd"]["starttime"]
+        ax = axes[idx, 0]
+        _plot_trace(ax, info["obsd"], reftime, color="k", label="obsd")
+        _plot_trace(ax, info["synt"], reftime, color="r", label="synt")
+        for left, right in info["windows"]:
+            ax.axvspan(left, right, color="b", alpha=0.1)
+        ax.set_title("%s(%d windows)" % (trace_id, len(info["windows"])))
+        ax.legend(loc="upper right")
+        idx += 1
+        if "adjsrc" in info:
+            ax = axes[idx, 0]
+            _plot_trace(ax, info["adjsrc"], reftime, color="g")
+            ax.set_title("Adjoint source(misfit: %.4e)"
+                         % info["adjsrc"]["misfit"])
+            idx += 1
+
+    axes[-1, 0].set_xlabel("Time(s)")
+    plt.tight_layout()
+    figname = payload_file[:-len(PAYLOAD_SUFFIX)] + "." + figure_format
+    plt.savefig(figname)
+    plt.close(fig)
+
+
+def render_figures(figure_dir, comm=None, figure_format="pdf",
+                   remove_payload=True):
+    """
+    Render all the figures from payload files in figure_dir. If comm
+    is provided, payload files will be split among the ranks.
+    """
+    if comm is not None:
+        comm.barrier()
+        rank = comm.rank
+        if rank == 0:
+            payload_files = sorted(
+                glob.glob(os.path.join(figure_dir, "*" + PAYLOAD_SUFFIX)))
+            print("Number of figures to be rendered: %d"
+                  % len(payload_files))
+            jobs = [payload_files[_i::comm.size] for _i in range(comm.size)]
+        else:
+            jobs = None
+        payload_files = comm.scatter(jobs, root=0)
+    else:
+        payload_files = sorted(
+            glob.glob(os.path.join(figure_dir, "*" + PAYLOAD_SUFFIX)))
+
+    for payload_file in payload_files:
+        try:
+            render_one_figure(payload_file, figure_format=figure_format)
+        except Exception as err:
+            print("Failed to render figure(%s) due to: %s"
+                  % (payload_file, err))
+            continue
+        if remove_payload:
+            os.remove(payload_file)
+
+    if comm is not None:
+        comm.barrier()
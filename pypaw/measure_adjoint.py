@@ -11,43 +11,156 @@ Class that calculate adjoint source using asdf
 """
 from __future__ import (absolute_import, division, print_function)
 from functools import partial
+from copy import deepcopy
+from obspy import Stream, UTCDateTime
 from pyasdf import ASDFDataSet
 from pytomo3d.adjoint import measure_adjoint_on_stream
 from .adjoint import load_adjoint_config, AdjointASDF
-from .utils import dump_json
+from .multitaper import dpss_cache_installed, merge_dpss_cache_stats, \
+    report_dpss_cache_stats
+from .utils import tree_reduce
 
 
-def write_measurements(content, filename):
-    content_filter = dict(
-        (k, v) for k, v in content.iteritems() if v is not None)
-    dump_json(content_filter, filename)
+def _window_time_ranges(window_sta, margin):
+    """
+    Get the time range covered by windows(plus margin) for each
+    component, as {component: (starttime, endtime)}
+    """
+    ranges = {}
+    for trace_id, trace_win in window_sta.iteritems():
+        if len(trace_win) == 0:
+            continue
+        t1 = min([UTCDateTime(_w["absolute_starttime"])
+                  for _w in trace_win]) - margin
+        t2 = max([UTCDateTime(_w["absolute_endtime"])
+                  for _w in trace_win]) + margin
+        comp = trace_id[-1]
+        if comp in ranges:
+            t1 = min(t1, ranges[comp][0])
+            t2 = max(t2, ranges[comp][1])
+        ranges[comp] = (t1, t2)
+    return ranges
+
+
+def read_windowed_stream(station_group, tag, ranges, trace_ids=None):
+    """
+    Read only the samples inside the time ranges from the station group,
+    instead of the full traces.
+
+    :param ranges: time ranges for each component, from
+        _window_time_ranges
+    :param trace_ids: only read the traces with these ids. If None,
+        traces are only selected by component.
+    """
+    st = Stream()
+    for name in station_group.list():
+        if name == "StationXML" or name.split("__")[-1] != tag:
+            continue
+        trace_id = name.split("__")[0]
+        if trace_ids is not None and trace_id not in trace_ids:
+            continue
+        comp = trace_id[-1]
+        if comp not in ranges:
+            continue
+        st += station_group.get_item(name, starttime=ranges[comp][0],
+                                     endtime=ranges[comp][1])
+    return st
+
+
+def shift_windows(window_sta, observed):
+    """
+    Shift the windows to be relative to the start of the traces in
+    observed, which are read only over the windowed range.
+    """
+    new_windows = {}
+    for trace_id, trace_win in window_sta.iteritems():
+        trs = observed.select(id=trace_id)
+        if len(trs) == 0:
+            continue
+        starttime = trs[0].stats.starttime
+        dt = trs[0].stats.delta
+        new_windows[trace_id] = []
+        for win in trace_win:
+            win = deepcopy(win)
+            win["relative_starttime"] = \
+                UTCDateTime(win["absolute_starttime"]) - starttime
+            win["relative_endtime"] = \
+                UTCDateTime(win["absolute_endtime"]) - starttime
+            offset = win["left_index"] - \
+                int(round(win["relative_starttime"] / dt))
+            for key in ["left_index", "right_index", "center_index"]:
+                win[key] -= offset
+            if "time_of_first_sample" in win:
+                win["time_of_first_sample"] = str(starttime)
+            new_windows[trace_id].append(win)
+    return new_windows
+
+
+def load_station_data(obsd_station_group, synt_station_group, obsd_tag,
+                      synt_tag, windows, window_margin=None):
+    """
+    Load the observed and synthetic streams, together with windows, of
+    one station. Return None if the station has no windows or misses
+    data.
+
+    :param window_margin: if not None, only samples inside the windows
+        (extended by window_margin seconds on both sides) will be read,
+        rather than the full traces.
+    :type window_margin: float
+    :return: (observed, synthetic, window_sta)
+    """
+    # stations without windows are skipped before reading any data
+    window_sta = windows.get(obsd_station_group._station_name)
+    if not window_sta or \
+            all([len(_w) == 0 for _w in window_sta.itervalues()]):
+        return
+
+    if window_margin is not None:
+        if obsd_tag not in obsd_station_group.get_waveform_tags():
+            print("Missing tag '%s' from obsd_station_group %s. Skipped." %
+                  (obsd_tag, obsd_station_group._station_name))
+            return
+        if synt_tag not in synt_station_group.get_waveform_tags():
+            print("Missing tag '%s' from synt_station_group %s. Skipped." %
+                  (synt_tag, synt_station_group._station_name))
+            return
+        ranges = _window_time_ranges(window_sta, window_margin)
+        observed = read_windowed_stream(obsd_station_group, obsd_tag,
+                                        ranges, trace_ids=window_sta.keys())
+        synthetic = read_windowed_stream(synt_station_group, synt_tag,
+                                         ranges)
+        window_sta = shift_windows(window_sta, observed)
+    else:
+        # Make sure everything thats required is there.
+        if not hasattr(obsd_station_group, obsd_tag):
+            print("Missing tag '%s' from obsd_station_group %s. Skipped." %
+                  (obsd_tag, obsd_station_group._station_name))
+            return
+        if not hasattr(synt_station_group, synt_tag):
+            print("Missing tag '%s' from synt_station_group %s. Skipped." %
+                  (synt_tag, synt_station_group._station_name))
+            return
+        observed = getattr(obsd_station_group, obsd_tag)
+        synthetic = getattr(synt_station_group, synt_tag)
+
+    return observed, synthetic, window_sta
 
 
 def measure_adjoint_wrapper(
         obsd_station_group, synt_station_group, config=None,
         obsd_tag=None, synt_tag=None, windows=None,
-        adj_src_type="multitaper_misfit"):
-
-    # Make sure everything thats required is there.
-    if not hasattr(obsd_station_group, obsd_tag):
-        print("Missing tag '%s' from obsd_station_group %s. Skipped." %
-              (obsd_tag, obsd_station_group._station_name))
-        return
-    if not hasattr(synt_station_group, synt_tag):
-        print("Missing tag '%s' from synt_station_group %s. Skipped." %
-              (synt_tag, synt_station_group._station_name))
-        return
-    if not hasattr(obsd_station_group, "StationXML"):
-        print("Missing tag 'STATIONXML' from obsd_station_group %s. Skipped" %
-              (obsd_tag, obsd_station_group._station_name))
+        adj_src_type="multitaper_misfit", window_margin=None):
+    """
+    Function wrapper for pyasdf.
 
-    try:
-        window_sta = windows[obsd_station_group._station_name]
-    except:
+    :param window_margin: see load_station_data
+    """
+    data = load_station_data(obsd_station_group, synt_station_group,
+                             obsd_tag, synt_tag, windows,
+                             window_margin=window_margin)
+    if data is None:
         return
-
-    observed = getattr(obsd_station_group, obsd_tag)
-    synthetic = getattr(synt_station_group, synt_tag)
+    observed, synthetic, window_sta = data
 
     results = measure_adjoint_on_stream(
         observed, synthetic, window_sta, config, adj_src_type,
@@ -93,10 +206,20 @@ class MeasureAdjointASDF(AdjointASDF):
         synt_ds = self.load_asdf(synt_file, mode="r")
 
         windows = self.load_windows(window_file)
+        # only stations with windows will be dispatched
+        stations = self.get_window_stations(windows)
+        if self.rank == 0:
+            print("Number of stations with windows: %d" % len(stations))
 
         adj_src_type = adjoint_param["adj_src_type"]
         adjoint_param.pop("adj_src_type", None)
 
+        # only read the windowed samples, with one max_period on both
+        # sides as margin
+        window_margin = None
+        if param.get("window_restricted_read", False):
+            window_margin = adjoint_param["max_period"]
+
         config = load_adjoint_config(adjoint_param, adj_src_type)
 
         if self.mpi_mode and self.rank == 0:
@@ -107,14 +230,20 @@ class MeasureAdjointASDF(AdjointASDF):
         if self.mpi_mode:
             self.comm.barrier()
 
-        measure_adj_func = \
-            partial(measure_adjoint_wrapper, config=config,
-                    obsd_tag=obsd_tag, synt_tag=synt_tag,
-                    windows=windows,
-                    adj_src_type=adj_src_type)
-
-        results = obsd_ds.process_two_files(synt_ds, measure_adj_func)
-
+        with dpss_cache_installed() as dpss_cache:
+            measure_adj_func = \
+                partial(measure_adjoint_wrapper, config=config,
+                        obsd_tag=obsd_tag, synt_tag=synt_tag,
+                        windows=windows, adj_src_type=adj_src_type,
+                        window_margin=window_margin)
+
+            # results are kept on each rank rather than gathered to rank 0
+            results = self.process_two_files_no_gather(
+                obsd_ds, synt_ds, measure_adj_func, stations=stations)
+        dpss_stats = tree_reduce(dpss_cache.stats(), merge_dpss_cache_stats,
+                                 comm=self.comm)
         if self.rank == 0:
-            print("output filename: %s" % output_filename)
-            write_measurements(results, output_filename)
+            report_dpss_cache_stats(dpss_stats)
+
+        # each rank writes its own shard, which are then merged on rank 0
+        self.write_measurements_sharded(results, output_filename)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cross-event misfit database, stored as a local SQLite file. Each event
+is added(or replaced) as soon as its adjoint sources are summed, so
+the overall misfit of one iteration could be queried at any time,
+without re-reading all the misfit json files.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import sqlite3
+from .utils import read_json_file
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event TEXT PRIMARY KEY,
+    source_file TEXT,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS misfits (
+    event TEXT,
+    period TEXT,
+    component TEXT,
+    misfit REAL,
+    raw_misfit REAL,
+    PRIMARY KEY (event, period, component)
+);
+CREATE INDEX IF NOT EXISTS misfits_period_component
+    ON misfits (period, component);
+"""
+
+GROUP_KEYS = ["event", "period", "component"]
+
+
+def connect_misfit_db(db_file):
+    """ Open(and create if not exists) the misfit database """
+    # wait for other jobs which are adding events at the same time
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add_event_misfits(conn, event, misfits, source_file=None, mtime=None):
+    """
+    Add the misfits of one event into the database. Records of the
+    same event already in the database are replaced.
+
+    :param misfits: misfits of one event, same as the content of
+        the adjoint misfit json file from PostAdjASDF, as
+        {period: {component: {"misfit": value, "raw_misfit": value}}}
+    """
+    rows = []
+    for period, period_info in misfits.iteritems():
+        for comp, comp_info in period_info.iteritems():
+            rows.append((event, period, comp, comp_info["misfit"],
+                         comp_info.get("raw_misfit")))
+    with conn:
+        conn.execute("DELETE FROM misfits WHERE event = ?", (event,))
+        conn.executemany("INSERT INTO misfits VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?)",
+                     (event, source_file, mtime))
+
+
+def misfit_file_to_event(filename):
+    """ "C201001122153A.adjoint.misfit.json" --> "C201001122153A" """
+    return os.path.basename(filename).split(".adjoint.misfit.json")[0]
+
+
+def update_misfit_db(conn, filelist):
+    """
+    Add misfit json files into the database, as {event: filename}.
+    Files already added and not modified since are skipped.
+
+    :return: number of events(re-)added
+    """
+    known = dict(conn.execute("SELECT event, mtime FROM events"))
+    nadded = 0
+    for event, filename in sorted(filelist.iteritems()):
+        if not os.path.exists(filename):
+            print("Misfit file not exists: %s" % filename)
+            continue
+        mtime = os.path.getmtime(filename)
+        if known.get(event) == mtime:
+            continue
+        add_event_misfits(conn, event, read_json_file(filename),
+                          source_file=filename, mtime=mtime)
+        nadded += 1
+    return nadded
+
+
+def query_misfits(conn, group_by=("period", "component"), events=None):
+    """
+    Sum the misfits, grouped by keys in group_by(any of "event",
+    "period" and "component")
+
+    :param events: only sum over these events. If None, all events
+        in the database are used.
+    :return: nested dict in the order of group_by, with the summed
+        misfit as values. If group_by is empty, the total misfit.
+    """
+    for key in group_by:
+        if key not in GROUP_KEYS:
+            raise ValueError("Unrecognized group key(%s), should be "
+                             "in %s" % (key, GROUP_KEYS))
+    sql = "SELECT %s FROM misfits" % \
+        ", ".join(list(group_by) + ["SUM(misfit)"])
+    args = []
+    if events is not None:
+        events = list(events)
+        sql += " WHERE event IN (%s)" % ", ".join(["?"] * len(events))
+        args = events
+    if len(group_by) > 0:
+        sql += " GROUP BY %s" % ", ".join(group_by)
+
+    results = {}
+    for row in conn.execute(sql, args):
+        if len(group_by) == 0:
+            return row[0] or 0.0
+        _dict = results
+        for key in row[:-2]:
+            _dict = _dict.setdefault(key, {})
+        _dict[row[-2]] = row[-1]
+    return results
+
+
+def list_events(conn):
+    return [row[0] for row in
+            conn.execute("SELECT event FROM events ORDER BY event")]
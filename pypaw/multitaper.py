@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cache of the DPSS tapers used by pyadjoint's multitaper measurements,
+so the tapers are computed once for windows of the same length,
+instead of once per window.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+from collections import OrderedDict
+from contextlib import contextmanager
+import importlib
+import numpy as np
+from pyadjoint import dpss
+
+
+# pyadjoint modules which import dpss_windows by name
+PYADJOINT_DPSS_MODULES = ["pyadjoint.adjoint_source_types.multitaper_misfit"]
+
+
+class DPSSCache(object):
+    """
+    Bounded LRU cache of DPSS tapers, keyed on (npts, nw, ntaper).
+    Hits and misses are counted for instrumentation.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def dpss_windows(self, npts, nw, ntaper, **kwargs):
+        """
+        Same interface and return values as pyadjoint.dpss.dpss_windows.
+        Copies are returned so callers could modify them in place.
+        """
+        key = (npts, nw, ntaper, tuple(sorted(kwargs.items())))
+        if key in self._cache:
+            self.hits += 1
+            value = self._cache.pop(key)
+        else:
+            self.misses += 1
+            value = dpss.dpss_windows(npts, nw, ntaper, **kwargs)
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+        self._cache[key] = value
+        return tuple(np.copy(_v) for _v in value)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._cache)}
+
+
+def merge_dpss_cache_stats(stats_a, stats_b):
+    return dict((key, stats_a[key] + stats_b[key]) for key in stats_a)
+
+
+def report_dpss_cache_stats(stats):
+    total = stats["hits"] + stats["misses"]
+    rate = stats["hits"] / total if total > 0 else 0.0
+    print("DPSS taper cache: %d hits, %d misses, hit rate %.2f%%"
+          % (stats["hits"], stats["misses"], rate * 100))
+
+
+@contextmanager
+def dpss_cache_installed(maxsize=256):
+    """
+    Install a DPSS cache into pyadjoint for the duration of the with
+    block, so tapers are shared by all the windows measured. The cache
+    is yielded for the instrumentation.
+    """
+    cache = DPSSCache(maxsize=maxsize)
+    originals = {}
+    for modname in PYADJOINT_DPSS_MODULES:
+        try:
+            module = importlib.import_module(modname)
+        except ImportError:
+            continue
+        if hasattr(module, "dpss_windows"):
+            originals[module] = module.dpss_windows
+            module.dpss_windows = cache.dpss_windows
+    try:
+        yield cache
+    finally:
+        for module, func in originals.iteritems():
+            module.dpss_windows = func
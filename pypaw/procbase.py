@@ -155,6 +155,43 @@ class ProcASDFBase(object):
                           % filename)
                 smart_remove_file(filename)
 
+    def process_two_files_no_gather(self, obsd_ds, synt_ds, process_function,
+                                    stations=None):
+        """
+        Process two asdf files in parallel, the same way as
+        pyasdf.ASDFDataSet.process_two_files. The difference is that
+        results are kept on the rank that computes them, rather than
+        gathered to rank 0.
+
+        :param stations: stations to be processed. If None, all stations
+            in both files will be processed
+        :return: results of stations processed on this rank
+        """
+        if self.rank == 0:
+            usable_stations = set(obsd_ds.waveforms.list()).intersection(
+                set(synt_ds.waveforms.list()))
+            if stations is not None:
+                usable_stations = usable_stations.intersection(set(stations))
+            usable_stations = sorted(usable_stations)
+            total_job_count = len(usable_stations)
+            print("Number of stations to be processed: %d" % total_job_count)
+            size = self.comm.Get_size()
+            jobs = [usable_stations[_i::size] for _i in range(size)]
+        else:
+            jobs = None
+        jobs = self.comm.scatter(jobs, root=0)
+
+        results = {}
+        for station in jobs:
+            try:
+                results[station] = process_function(
+                    getattr(obsd_ds.waveforms, station),
+                    getattr(synt_ds.waveforms, station))
+            except Exception as err:
+                print("Error during the processing of station '%s' on "
+                      "rank %d: %s" % (station, self.rank, err))
+        return results
+
     @staticmethod
     def clean_memory(asdf_ds):
         """
@@ -34,15 +34,19 @@ def check_param_keywords(param):
         raise ValueError("Param is not consistent with function argument list")
 
 
-def process_wrapper(stream, inv, param=None):
+def process_wrapper(stream, inv, param=None, trim_window=None):
     """
     Process function wrapper for pyasdf
 
     :param stream:
     :param inv:
     :param param:
+    :param trim_window: (starttime, endtime) to cut the stream before
+        processing. If None, the whole stream will be processed.
     :return:
     """
+    if trim_window is not None:
+        stream.trim(starttime=trim_window[0], endtime=trim_window[1])
     param["inventory"] = inv
     return process_stream(stream, **param)
 
@@ -64,6 +68,29 @@ def update_param(event, param):
     param["event_longitude"] = event_longitude
 
 
+def calculate_trim_window(param):
+    """
+    Calculate the time span that needs to be kept before processing.
+    It is the interpolation range [starttime, endtime] extended on both
+    sides so that the taper falls outside of the range, plus the longest
+    period of the filter band to absorb the filter edge effects.
+    Should be called after update_param.
+    """
+    starttime = param["starttime"]
+    endtime = param["endtime"]
+    taper_percentage = param["taper_percentage"]
+    if taper_percentage >= 0.5:
+        raise ValueError("taper_percentage(%f) should be smaller than 0.5"
+                         % taper_percentage)
+
+    margin = taper_percentage * (endtime - starttime) / \
+        (1.0 - 2 * taper_percentage)
+    if param["filter_flag"] and param["pre_filt"] is not None:
+        margin += 1.0 / param["pre_filt"][0]
+
+    return starttime - margin, endtime + margin
+
+
 class ProcASDF(ProcASDFBase):
 
     def __init__(self, path, param, verbose=False, debug=False):
@@ -100,13 +127,23 @@ class ProcASDF(ProcASDFBase):
         # otherwise, it there will be errors
         ds = self.load_asdf(input_asdf, mode='a')
 
+        # trim_flag is not an argument of process_stream so pop it out
+        trim_flag = param.pop("trim_flag", False)
+
         # update param based on event information
         update_param(ds.events[0], param)
         # check final param to see if the keys are right
         check_param_keywords(param)
 
+        trim_window = None
+        if trim_flag:
+            trim_window = calculate_trim_window(param)
+            if self.rank == 0:
+                print("Trim stream before processing: [%s, %s]"
+                      % (trim_window[0], trim_window[1]))
+
         process_function = \
-            partial(process_wrapper, param=param)
+            partial(process_wrapper, param=param, trim_window=trim_window)
 
         tag_map = {input_tag: output_tag}
         ds.process(process_function, output_asdf, tag_map=tag_map)
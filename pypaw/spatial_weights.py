@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vectorized geographical weighting of receivers(or sources). Locations
+are loaded into numpy arrays and the great circle distance matrix is
+computed once, then reused by all the reference distances scanned.
+
+The weight of point i is 1 / sum_j exp(-(d_ij / d_0)^2), with d_ij the
+epicentral distance(in degree) between point i and j and d_0 the
+reference distance. d_0 is scanned and the one whose condition number
+(max weight / min weight) is closest to search_ratio times the maximum
+condition number is used.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import os
+import numpy as np
+from pypaw.utils import read_json_file
+from pypaw.window_counts import count_receiver_windows, \
+    drop_empty_channels, load_window_counts
+
+
+def sphere_to_cartesian(latitudes, longitudes):
+    """ Locations on the unit sphere, in shape of (npoints, 3) """
+    lat = np.deg2rad(np.asarray(latitudes, dtype=np.float64))
+    lon = np.deg2rad(np.asarray(longitudes, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_degree(chord):
+    """ chord length on the unit sphere to great circle distance """
+    return np.rad2deg(2 * np.arcsin(np.clip(chord / 2.0, 0.0, 1.0)))
+
+
+def great_circle_distance_matrix(latitudes, longitudes):
+    """ Pairwise great circle distances(in degree) between all points """
+    xyz = sphere_to_cartesian(latitudes, longitudes)
+    chord = np.sqrt(np.maximum(2.0 - 2.0 * np.dot(xyz, xyz.T), 0.0))
+    return chord_to_degree(chord)
+
+
+class DistanceWeighting(object):
+    """
+    Distance based weighting on a set of points, with the squared
+    distance matrix kept for all the reference distances scanned
+    """
+    def __init__(self, latitudes, longitudes):
+        self.npoints = len(latitudes)
+        self.dist_sq = great_circle_distance_matrix(
+            latitudes, longitudes) ** 2
+
+    def calculate_weights(self, ref_distance):
+        return 1.0 / np.sum(np.exp(-self.dist_sq / ref_distance ** 2),
+                            axis=1)
+
+    def scan(self, search_ratio, start=0.1, gap=0.3, drop_ratio=0.95,
+             max_distance=180.0):
+        """
+        Scan the reference distance from start with step gap, until
+        the condition number drops below drop_ratio of its maximum or
+        max_distance is reached.
+
+        :return: (ref_distance, cond_number, weights, ref_distances
+            scanned, cond_numbers scanned)
+        """
+        ref_dists = []
+        cond_nums = []
+        ref_dist = start
+        while ref_dist <= max_distance:
+            weights = self.calculate_weights(ref_dist)
+            ref_dists.append(ref_dist)
+            cond_nums.append(np.max(weights) / np.min(weights))
+            if cond_nums[-1] < drop_ratio * max(cond_nums):
+                break
+            ref_dist += gap
+
+        cond_nums = np.array(cond_nums)
+        # only search before the condition number reaches its peak
+        peak = np.argmax(cond_nums)
+        target = search_ratio * cond_nums[peak]
+        idx = np.argmin(np.abs(cond_nums[:peak + 1] - target))
+        ref_dist = ref_dists[idx]
+        weights = self.calculate_weights(ref_dist)
+        return ref_dist, cond_nums[idx], weights, np.array(ref_dists), \
+            cond_nums
+
+
+def plot_scan(figname, ref_dists, cond_nums, ref_dist):
+    # matplotlib is only required for plotting
+    import matplotlib.pyplot as plt
+    plt.switch_backend('agg')
+    plt.figure()
+    plt.plot(ref_dists, cond_nums, 'b.-')
+    plt.axvline(ref_dist, color='r')
+    plt.xlabel("Reference distance(degree)")
+    plt.ylabel("Condition number")
+    plt.savefig(figname)
+    plt.close()
+
+
+def load_station_locations(station_file):
+    """
+    Load the station json file(as {"NW.STA": [lat, lon, elev, depth]})
+    into arrays
+
+    :return: dict of "stations"(list of "NW.STA"), "index"
+        ({"NW.STA": idx}), "latitudes" and "longitudes"
+    """
+    content = read_json_file(station_file)
+    stations = sorted(content.keys())
+    return {"stations": stations,
+            "index": dict((_s, _i) for _i, _s in enumerate(stations)),
+            "latitudes": np.array([content[_s][0] for _s in stations]),
+            "longitudes": np.array([content[_s][1] for _s in stations])}
+
+
+def normalize_receiver_weights(weights, wcounts):
+    """ Normalize so that sum(weights * wcounts) = sum(wcounts) """
+    return weights * np.sum(wcounts) / np.sum(weights * wcounts)
+
+
+def calculate_receiver_weights_vectorized(locations, windows, param,
+                                          figure_prefix=None):
+    """
+    Calculate the receiver weights of one window file, for each
+    component. Output is the same as pytomo3d's
+    calculate_receiver_weights_interface.
+
+    :param locations: station locations from load_station_locations
+    :param windows: content of the window file
+    :param param: receiver weighting param, with keys "flag",
+        "search_ratio" and "plot"
+    """
+    rec_wcounts, cat_wcounts = drop_empty_channels(
+        *count_receiver_windows(windows))
+    return calculate_receiver_weights_on_counts(
+        locations, rec_wcounts, cat_wcounts, param,
+        figure_prefix=figure_prefix)
+
+
+def calculate_receiver_weights_on_counts(locations, rec_wcounts,
+                                         cat_wcounts, param,
+                                         figure_prefix=None):
+    """
+    Same as calculate_receiver_weights_vectorized, but on the window
+    counts(see pypaw.window_counts) instead of the windows
+    """
+    results = {"rec_weights": {}, "rec_wcounts": rec_wcounts,
+               "rec_ref_dists": {}, "rec_cond_nums": {},
+               "cat_wcounts": cat_wcounts}
+
+    for comp, comp_wcounts in rec_wcounts.iteritems():
+        chan_ids = sorted(
+            _c for _c in comp_wcounts
+            if ".".join(_c.split(".")[:2]) in locations["index"])
+        if len(chan_ids) < len(comp_wcounts):
+            print("[%s]Number of channels missing station locations: %d"
+                  % (comp, len(comp_wcounts) - len(chan_ids)))
+        idx = np.array([locations["index"][".".join(_c.split(".")[:2])]
+                        for _c in chan_ids], dtype=int)
+        wcounts = np.array([comp_wcounts[_c] for _c in chan_ids],
+                           dtype=np.float64)
+
+        ref_dist = -1.0
+        cond_num = -1.0
+        weights = np.ones(len(chan_ids))
+        if param["flag"] and len(chan_ids) > 1:
+            weighting = DistanceWeighting(locations["latitudes"][idx],
+                                          locations["longitudes"][idx])
+            ref_dist, cond_num, weights, ref_dists, cond_nums = \
+                weighting.scan(param["search_ratio"])
+            if param["plot"] and figure_prefix is not None:
+                plot_scan("%s.%s.smart_scan.png" % (figure_prefix, comp),
+                          ref_dists, cond_nums, ref_dist)
+
+        if len(chan_ids) > 0:
+            weights = normalize_receiver_weights(weights, wcounts)
+        results["rec_weights"][comp] = dict(
+            (_c, float(_w)) for _c, _w in zip(chan_ids, weights))
+        results["rec_ref_dists"][comp] = float(ref_dist)
+        results["rec_cond_nums"][comp] = float(cond_num)
+
+    return results
+
+
+def calculate_source_weights_on_arrays(latitudes, longitudes, param,
+                                       figname=None):
+    """
+    Geographical weights of sources, normalized so that the sum of
+    weights is the number of sources.
+
+    :param param: source weighting param, same keys as the receiver
+        weighting param
+    :return: (weights, ref_distance, cond_number)
+    """
+    npoints = len(latitudes)
+    ref_dist = -1.0
+    cond_num = -1.0
+    weights = np.ones(npoints)
+    if param["flag"] and npoints > 1:
+        weighting = DistanceWeighting(latitudes, longitudes)
+        ref_dist, cond_num, weights, ref_dists, cond_nums = \
+            weighting.scan(param["search_ratio"])
+        if param["plot"] and figname is not None:
+            plot_scan(figname, ref_dists, cond_nums, ref_dist)
+    weights = weights * npoints / np.sum(weights)
+    return weights, float(ref_dist), float(cond_num)
+
+
+def calculate_receiver_weights_on_files(path_info, param, locations=None,
+                                        counts_cache_dir=None):
+    """
+    Same interface as pytomo3d's calculate_receiver_weights_interface,
+    except the source information(only used in plotting there) and the
+    station locations could be passed in, so they are only loaded once
+    for all the period bands of one event.
+
+    :param path_info: dict with keys "station_file", "window_file" and
+        "output_file"
+    :param counts_cache_dir: cache directory of the window counts, see
+        pypaw.window_counts
+    """
+    if locations is None:
+        locations = load_station_locations(path_info["station_file"])
+    counts = load_window_counts(path_info["window_file"],
+                                cache_dir=counts_cache_dir, skip_empty=True)
+    figure_prefix = os.path.join(os.path.dirname(path_info["output_file"]),
+                                 "receiver_weights")
+    return calculate_receiver_weights_on_counts(
+        locations, counts["rec_wcounts"], counts["cat_wcounts"], param,
+        figure_prefix=figure_prefix)
@@ -12,6 +12,7 @@ asdf file.
 from __future__ import (print_function, division, absolute_import)
 import pyasdf
 from pytomo3d.station import extract_staxml_info
+from .adjoint_params import read_adjoint_parameters
 
 
 def extract_station_info_from_asdf(asdf, verbose=False):
@@ -73,27 +74,28 @@ def extract_waveform_stations(asdf, stations=None):
 
 def extract_adjoint_stations(asdf, stations=None):
     """
-    Extract station information from adjoint source group
+    Extract station information from adjoint source group. If asdf is
+    a filename, only the attributes are read through h5py.
     """
     if isinstance(asdf, str):
-        ds = pyasdf.ASDFDataSet(asdf, mode='r')
+        all_parameters = read_adjoint_parameters(asdf, names=stations)
     elif isinstance(asdf, pyasdf.ASDFDataSet):
-        ds = asdf
+        try:
+            adjsrcs = asdf.auxiliary_data.AdjointSources
+        except:
+            return {}
+        if stations is None:
+            stations = adjsrcs.list()
+        all_parameters = dict(
+            (_name, getattr(adjsrcs, _name).parameters)
+            for _name in stations)
     else:
         raise TypeError("Input asdf either be a filename or "
                         "pyasdf.ASDFDataSet")
 
     sta_dict = {}
-    try:
-        adjsrcs = ds.auxiliary_data.AdjointSources
-    except:
-        return {}
-
-    if stations is None:
-        stations = adjsrcs.list()
-    for adj_name in stations:
-        adj = getattr(adjsrcs, adj_name)
-        pars = adj.parameters
+    for adj_name in sorted(all_parameters):
+        pars = all_parameters[adj_name]
         station_id = pars["station_id"]
         if station_id not in sta_dict:
             sta_dict[station_id] = [pars["latitude"], pars["longitude"],
@@ -14,15 +14,28 @@ each channel
 """
 from __future__ import print_function, division, absolute_import
 import os
+import heapq
+import shutil
+import tempfile
+from itertools import groupby
+from collections import Counter
+from multiprocessing import Pool
 from pprint import pprint
 from copy import deepcopy
+import numpy as np
+import h5py
+from obspy.geodetics import gps2dist_azimuth
 from pyasdf import ASDFDataSet
 from pytomo3d.adjoint.sum_adjoint import load_to_adjsrc, dump_adjsrc, \
     check_events_consistent, \
     create_weighted_adj, sum_adj_to_base, check_station_consistent, \
     rotate_adjoint_sources
+from .adjoint_params import AdjointSourceReader
+from .misfit_db import connect_misfit_db, add_event_misfits, \
+    misfit_file_to_event
 from .utils import read_json_file, dump_json, read_yaml_file, \
-    smart_remove_file
+    smart_remove_file, is_mpi_env, _get_mpi_comm, tree_reduce, \
+    shard_filename
 
 
 def validate_path(path):
@@ -63,14 +76,69 @@ def validate_param(param):
             print("Missing key(%s) in param" % k)
             err = 1
 
+    engine = param.get("summation_engine", "object")
+    if engine not in ["object", "vectorized"]:
+        print("Unrecognized summation_engine: %s" % engine)
+        err = 1
+    if param.get("band_processes", 1) > 1 and engine != "vectorized":
+        print("band_processes(%d) larger than 1 only works with "
+              "summation_engine 'vectorized', not '%s'"
+              % (param["band_processes"], engine))
+        err = 1
+
     if err:
         raise ValueError("Error in param file")
 
 
-def save_adjoint_to_asdf(outputfile, events, adjoint_sources, stations):
+def dump_adjoint_sources(adjoint_sources, stations):
+    """
+    Prepare all the adjoint sources for writing, as a list of
+    (adj_array, adj_path, parameters), sorted by adjoint source id
+    """
+    items = []
+    for adj_id in sorted(adjoint_sources):
+        adj = adjoint_sources[adj_id]
+        sta_tag = "%s_%s" % (adj.network, adj.station)
+        sta_info = stations[sta_tag]
+        items.append(dump_adjsrc(adj, sta_info))
+    return items
+
+
+def write_adjoint_datasets(outputfile, items):
+    """
+    Write the adjoint sources into AuxiliaryData/AdjointSources of an
+    existing asdf file in one h5py session. The datasets are laid out
+    as pyasdf does without compression, but contiguous rather than
+    chunked with checksums, which saves the per-dataset overhead.
+
+    :param items: output of dump_adjoint_sources
+    """
+    with h5py.File(outputfile, 'a') as fh:
+        group = fh.require_group("AuxiliaryData/AdjointSources")
+        write_adjoint_items(group, items)
+
+
+def write_adjoint_items(group, items):
+    """ Write the adjoint sources into an opened h5py group """
+    for adj_array, adj_path, parameters in items:
+        if adj_path in group:
+            print("Adjoint source '%s' already exists in file. Will "
+                  "not be added!" % adj_path)
+            continue
+        dataset = group.create_dataset(adj_path, data=np.asarray(adj_array))
+        for key, value in parameters.iteritems():
+            dataset.attrs[key] = value
+
+
+def save_adjoint_to_asdf(outputfile, events, adjoint_sources, stations,
+                         batch_write=True):
     """
     Save events(obspy.Catalog) and adjoint sources, together with
     staiton information, to asdf file on disk.
+
+    :param batch_write: write all the adjoint sources in one batch
+        through h5py, instead of one pyasdf call per adjoint source
+    :type batch_write: bool
     """
     print("="*15 + "\nWrite to file: %s" % outputfile)
     outputdir = os.path.dirname(outputfile)
@@ -81,16 +149,371 @@ def save_adjoint_to_asdf(outputfile, events, adjoint_sources, stations):
         print("Output file exists and removed:%s" % outputfile)
         os.remove(outputfile)
 
-    ds = ASDFDataSet(outputfile, mode='a', compression=None)
+    items = dump_adjoint_sources(adjoint_sources, stations)
+
+    ds = ASDFDataSet(outputfile, mode='a', compression=None, mpi=False)
     ds.add_quakeml(events)
-    for adj_id in sorted(adjoint_sources):
-        adj = adjoint_sources[adj_id]
-        sta_tag = "%s_%s" % (adj.network, adj.station)
-        sta_info = stations[sta_tag]
-        adj_array, adj_path, parameters = \
-            dump_adjsrc(adj, sta_info)
-        ds.add_auxiliary_data(adj_array, data_type="AdjointSources",
-                              path=adj_path, parameters=parameters)
+    if not batch_write:
+        for adj_array, adj_path, parameters in items:
+            ds.add_auxiliary_data(adj_array, data_type="AdjointSources",
+                                  path=adj_path, parameters=parameters)
+        return
+    # close the file before writing through h5py
+    del ds
+    write_adjoint_datasets(outputfile, items)
+
+
+class AdjointFileWriter(object):
+    """
+    Append adjoint sources to one asdf file in several calls. The file
+    is created(with events) only at the first adjoint source written,
+    so no file is generated if there is no adjoint source at all.
+    """
+    def __init__(self, outputfile, events, batch_write=True):
+        self.outputfile = outputfile
+        self.events = events
+        self.batch_write = batch_write
+        self._fh = None
+        self._group = None
+        self._ds = None
+
+    def _open(self):
+        save_adjoint_to_asdf(self.outputfile, self.events, {}, {},
+                             batch_write=self.batch_write)
+        if self.batch_write:
+            self._fh = h5py.File(self.outputfile, 'a')
+            self._group = self._fh.require_group(
+                "AuxiliaryData/AdjointSources")
+        else:
+            self._ds = ASDFDataSet(self.outputfile, mode='a',
+                                   compression=None, mpi=False)
+
+    def write(self, items):
+        """
+        :param items: output of dump_adjoint_sources
+        """
+        if len(items) == 0:
+            return
+        if self._group is None and self._ds is None:
+            self._open()
+        if self.batch_write:
+            write_adjoint_items(self._group, items)
+            return
+        for adj_array, adj_path, parameters in items:
+            self._ds.add_auxiliary_data(adj_array, data_type="AdjointSources",
+                                        path=adj_path, parameters=parameters)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = None
+        self._group = None
+        self._ds = None
+
+
+def calculate_baz(event_latitude, event_longitude, latitudes, longitudes):
+    """
+    Back azimuths(in degree) of all the stations, on the WGS84
+    ellipsoid, as obspy(and pytomo3d) does
+
+    :param latitudes: station latitudes, in shape of (nstations,)
+    :param longitudes: station longitudes, in shape of (nstations,)
+    """
+    return np.array([
+        gps2dist_azimuth(event_latitude, event_longitude, _lat, _lon)[2]
+        for _lat, _lon in zip(latitudes, longitudes)])
+
+
+class AdjointStack(object):
+    """
+    Summed adjoint sources kept as one 2D array(channels x npts). The
+    AdjointSource objects only carry the metadata(misfit, starttime,
+    dt and so on) and are summed through pytomo3d with empty data, so
+    the waveforms of one period band are accumulated in one numpy
+    operation.
+    """
+    def __init__(self):
+        self.adjoint_sources = {}
+        self.rows = {}
+        self.data = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _add_metadata(self, adj_id, adj, weight, npts):
+        if npts != self.data.shape[1]:
+            raise ValueError("Inconsistent npts of adjoint source: %d, %d"
+                             % (npts, self.data.shape[1]))
+        if adj_id not in self.adjoint_sources:
+            self.adjoint_sources[adj_id] = create_weighted_adj(adj, weight)
+        else:
+            sum_adj_to_base(self.adjoint_sources[adj_id], adj, weight)
+
+    def add(self, adj_ids, adjsrcs, data, weights):
+        """
+        Add the weighted adjoint sources of one period band. Adjoint
+        sources inconsistent with the ones already added(in npts or
+        in the checks of pytomo3d) are reported and skipped.
+
+        :param adj_ids: adjoint source ids, like "II_AAK_MXZ". Different
+            instruments of the same station share the same id
+        :param adjsrcs: AdjointSource objects with empty data
+        :param data: list of adjoint source data(1D arrays)
+        :param weights: channel weights, in shape of (nchannels,)
+        :return: indexes of the adjoint sources added
+        """
+        if len(adj_ids) == 0:
+            return []
+        if self.data is None:
+            # npts of the stack is taken as the most common one
+            npts = Counter([len(_d) for _d in data]).most_common(1)[0][0]
+            self.data = np.zeros((0, npts))
+
+        keep = []
+        for idx, (adj_id, adj, weight) in \
+                enumerate(zip(adj_ids, adjsrcs, weights)):
+            try:
+                self._add_metadata(adj_id, adj, weight, len(data[idx]))
+            except Exception as err:
+                print("Failed to add station adjsrc(%s) to db due to: %s"
+                      % (adj_id, str(err)))
+                continue
+            keep.append(idx)
+        if len(keep) == 0:
+            return keep
+
+        npts = self.data.shape[1]
+        adj_ids = [adj_ids[_i] for _i in keep]
+        data = np.array([data[_i] for _i in keep], dtype=np.float64)
+        weights = np.asarray(weights)[keep]
+
+        new_ids = sorted(set(adj_ids) - set(self.rows))
+        for adj_id in new_ids:
+            self.rows[adj_id] = len(self.rows)
+        if len(new_ids) > 0:
+            self.data = np.vstack([self.data, np.zeros((len(new_ids), npts))])
+
+        rows = np.array([self.rows[_id] for _id in adj_ids])
+        # unbuffered so that repeated rows are all added
+        np.add.at(self.data, rows, weights[:, np.newaxis] * data)
+        return keep
+
+    def rotate_rt_to_ne(self, stations, event_latitude, event_longitude):
+        """
+        Rotate the "MXR" and "MXT" adjoint sources of all stations to
+        "MXN" and "MXE" in one batch. If only one of R and T exists
+        on a station, the other one is taken as zero.
+
+        :param stations: station information, keyed by "NW_STA"
+        """
+        sta_ids = sorted(set(
+            _id.rsplit("_", 1)[0] for _id in self.rows
+            if _id.endswith("_MXR") or _id.endswith("_MXT")))
+        if len(sta_ids) == 0:
+            return
+
+        lats = np.array([stations[_s]["latitude"] for _s in sta_ids])
+        lons = np.array([stations[_s]["longitude"] for _s in sta_ids])
+        baz = np.deg2rad(calculate_baz(event_latitude, event_longitude,
+                                       lats, lons))[:, np.newaxis]
+
+        r_rows = np.array([self.rows.get(_s + "_MXR", -1) for _s in sta_ids])
+        t_rows = np.array([self.rows.get(_s + "_MXT", -1) for _s in sta_ids])
+        r = self.data[r_rows]
+        r[r_rows < 0] = 0.0
+        t = self.data[t_rows]
+        t[t_rows < 0] = 0.0
+        n = -r * np.cos(baz) + t * np.sin(baz)
+        e = -r * np.sin(baz) - t * np.cos(baz)
+
+        adjsrcs = {}
+        for sta in sta_ids:
+            for comp, base_comps in [("MXN", ["MXR", "MXT"]),
+                                     ("MXE", ["MXT", "MXR"])]:
+                base_id = [sta + "_" + _c for _c in base_comps
+                           if sta + "_" + _c in self.rows][0]
+                adj = deepcopy(self.adjoint_sources[base_id])
+                adj.component = comp
+                adjsrcs[sta + "_" + comp] = adj
+
+        keep_ids = sorted(_id for _id in self.rows
+                          if not (_id.endswith("_MXR") or
+                                  _id.endswith("_MXT")))
+        keep_rows = np.array([self.rows[_id] for _id in keep_ids], dtype=int)
+        new_ids = keep_ids + [_s + "_MXN" for _s in sta_ids] + \
+            [_s + "_MXE" for _s in sta_ids]
+        self.data = np.vstack([self.data[keep_rows], n, e])
+        self.rows = dict((_id, _i) for _i, _id in enumerate(new_ids))
+        for adj_id in keep_ids:
+            adjsrcs[adj_id] = self.adjoint_sources[adj_id]
+        self.adjoint_sources = adjsrcs
+
+    def to_adjoint_sources(self):
+        """ Attach the summed data to the AdjointSource objects """
+        adjsrcs = {}
+        for adj_id, row in self.rows.iteritems():
+            adj = self.adjoint_sources[adj_id]
+            adj.adjoint_source = self.data[row]
+            adjsrcs[adj_id] = adj
+        return adjsrcs
+
+
+def load_adjoint_band(adjsrc_group, weights):
+    """
+    Load the adjoint sources of one period band, for the channels in
+    weights. Channels failed to load are reported and skipped.
+
+    :param adjsrc_group: ds.auxiliary_data.AdjointSources, or an
+        AdjointSourceReader
+    :return: dict of channels, adj_ids, adjsrcs(with empty data),
+        station_infos, data(list of arrays), weights and misfits
+    """
+    band = {"channels": [], "adj_ids": [], "adjsrcs": [],
+            "station_infos": [], "data": [], "weights": [], "misfits": []}
+    for channel in sorted(weights):
+        _nw, _sta, _, _comp = channel.split(".")
+        adj_id = "%s_%s_MX%s" % (_nw, _sta, _comp[-1])
+        try:
+            adj, station_info = load_to_adjsrc(adjsrc_group[adj_id])
+        except Exception as err:
+            print("Failed to load adjsrc(%s) due to: %s"
+                  % (channel, str(err)))
+            continue
+        band["data"].append(np.asarray(adj.adjoint_source, dtype=np.float64))
+        adj.adjoint_source = np.zeros(0)
+        band["channels"].append(channel)
+        band["adj_ids"].append(adj_id)
+        band["adjsrcs"].append(adj)
+        band["station_infos"].append(station_info)
+        band["weights"].append(weights[channel]["weight"])
+        band["misfits"].append(adj.misfit)
+
+    band["weights"] = np.array(band["weights"], dtype=np.float64)
+    band["misfits"] = np.array(band["misfits"], dtype=np.float64)
+    return band
+
+
+def load_band_file(args):
+    """
+    Load one period band: events, channel weights and adjoint sources.
+    Used by the process pool, so only picklable objects are returned.
+
+    :param args: (period, asdf_file, weight_file, stations). If stations
+        is not None, only channels on these stations("NW.STA") are loaded
+    :return: (period, asdf_file, events, band)
+    """
+    period, asdf_file, weight_file, stations = args
+    ds = ASDFDataSet(asdf_file, mode='r', mpi=False)
+    events = ds.events
+    weights = read_json_file(weight_file)
+    if stations is not None:
+        weights = dict((_c, _w) for _c, _w in weights.iteritems()
+                       if ".".join(_c.split(".")[:2]) in stations)
+    del ds
+    # parameters are read in bulk from the attributes
+    with AdjointSourceReader(asdf_file) as adjsrc_group:
+        band = load_adjoint_band(adjsrc_group, weights)
+    return period, asdf_file, events, band
+
+
+def load_band_file_to_disk(args):
+    """
+    Same as load_band_file, but the adjoint source data is written into
+    data_file(as one concatenated array), so only the metadata is sent
+    back from the process pool, instead of pickling all the data.
+
+    :param args: (period, asdf_file, weight_file, stations, data_file)
+    :return: (period, asdf_file, events, band), with band["data"]
+        replaced by band["data_file"] and band["data_offsets"]
+    """
+    data_file = args[-1]
+    period, asdf_file, events, band = load_band_file(args[:-1])
+    offsets = np.cumsum([0] + [len(_d) for _d in band["data"]])
+    if len(band["data"]) > 0:
+        data = np.concatenate(band["data"])
+    else:
+        data = np.zeros(0)
+    np.save(data_file, data)
+    band["data"] = None
+    band["data_file"] = data_file
+    band["data_offsets"] = offsets
+    return period, asdf_file, events, band
+
+
+def load_band_data(band):
+    """
+    Load the data written by load_band_file_to_disk back into band, as
+    views of one memory mapped array
+    """
+    data = np.load(band["data_file"], mmap_mode='r')
+    offsets = band["data_offsets"]
+    band["data"] = [data[offsets[_i]:offsets[_i + 1]]
+                    for _i in range(len(offsets) - 1)]
+    return band
+
+
+def sum_band_misfits(channels, weights, misfits):
+    """ Weighted and raw misfit summed on each component """
+    comps = np.array([_c.split(".")[-1] for _c in channels])
+    misfits_comp = {}
+    for comp in np.unique(comps):
+        mask = (comps == comp)
+        misfits_comp[str(comp)] = {
+            "misfit": float(np.sum(weights[mask] * misfits[mask])),
+            "raw_misfit": float(np.sum(misfits[mask]))}
+    return misfits_comp
+
+
+def iter_station_channels(weights, band_index):
+    """
+    Iterate over the stations in weights in sorted order, yielding
+    (station, band_index, channels). Station is like "NW.STA".
+    """
+    def _station(channel):
+        return ".".join(channel.split(".")[:2])
+
+    for station, channels in groupby(sorted(weights), key=_station):
+        yield station, band_index, list(channels)
+
+
+def merge_adjoint_shards(shard_files, outputfile, events):
+    """
+    Merge the adjoint sources in shard asdf files into outputfile. The
+    HDF5 datasets are copied as they are, without going through pyasdf.
+    """
+    save_adjoint_to_asdf(outputfile, events, {}, {})
+    with h5py.File(outputfile, 'a') as fout:
+        adjsrc_group = fout.require_group("AuxiliaryData/AdjointSources")
+        for shard_file in shard_files:
+            if not os.path.exists(shard_file):
+                continue
+            with h5py.File(shard_file, 'r') as fin:
+                if "AuxiliaryData/AdjointSources" in fin:
+                    src_group = fin["AuxiliaryData/AdjointSources"]
+                    for name in src_group:
+                        fin.copy(src_group[name], adjsrc_group, name=name)
+            os.remove(shard_file)
+
+
+def add_misfits(misfits, new_misfits):
+    """
+    Add the misfits({period: {comp: {key: value}}}) of new_misfits to
+    misfits in place
+    """
+    for period, period_misfits in new_misfits.iteritems():
+        period_base = misfits.setdefault(period, {})
+        for comp, comp_misfits in period_misfits.iteritems():
+            if comp not in period_base:
+                period_base[comp] = dict(comp_misfits)
+                continue
+            for key, value in comp_misfits.iteritems():
+                period_base[comp][key] += value
+    return misfits
+
+
+def merge_misfits(misfits_a, misfits_b):
+    """ Sum the misfits({period: {comp: {key: value}}}) from two parts """
+    return add_misfits(deepcopy(misfits_a), misfits_b)
 
 
 def check_event_information_in_asdf_files(asdf_files):
@@ -100,7 +523,7 @@ def check_event_information_in_asdf_files(asdf_files):
     asdf_events = {}
     # extract event information from asdf file
     for asdf_fn in asdf_files:
-        ds = ASDFDataSet(asdf_fn, mode='r')
+        ds = ASDFDataSet(asdf_fn, mode='r', mpi=False)
         asdf_events[asdf_fn] = ds.events
 
     check_events_consistent(asdf_events)
@@ -128,6 +551,7 @@ class PostAdjASDF(object):
 
         # adjoint sources
         self.adjoint_sources = {}
+        self.adjoint_stack = AdjointStack()
         self.misfits = {}
 
     def attach_adj_to_db(self, channel_id, adj, weight):
@@ -201,6 +625,51 @@ class PostAdjASDF(object):
         pprint(misfits)
         return misfits
 
+    def add_adjoint_dataset_vectorized(self, ds, weights):
+        """
+        Same as add_adjoint_dataset_on_channel_weight, but the adjoint
+        sources are loaded as one 2D array and summed into
+        self.adjoint_stack in one operation
+        """
+        if len(weights) == 0:
+            return {}
+        return self.add_adjoint_band(
+            load_adjoint_band(ds.auxiliary_data.AdjointSources, weights))
+
+    def add_adjoint_band(self, band, verbose=True):
+        """
+        Add one period band, loaded by load_adjoint_band, into
+        self.adjoint_stack
+        """
+        if len(band["channels"]) == 0:
+            return {}
+
+        keep = []
+        for idx, station_info in enumerate(band["station_infos"]):
+            try:
+                self.attach_station_to_db(station_info)
+            except Exception as err:
+                print("Failed to add station information(%s) to db due to: %s"
+                      % (band["channels"][idx], str(err)))
+                continue
+            keep.append(idx)
+
+        # adjoint sources failed to add are reported and skipped inside,
+        # while their misfits are still counted, as in
+        # add_adjoint_dataset_on_channel_weight
+        self.adjoint_stack.add(
+            [band["adj_ids"][_i] for _i in keep],
+            [band["adjsrcs"][_i] for _i in keep],
+            [band["data"][_i] for _i in keep], band["weights"][keep])
+
+        misfits = sum_band_misfits(
+            [band["channels"][_i] for _i in keep], band["weights"][keep],
+            band["misfits"][keep])
+        if verbose:
+            print("Misfit:")
+            pprint(misfits)
+        return misfits
+
     def check_all_event_info(self):
         """
         Gather event information to make sure every asdf file
@@ -217,30 +686,173 @@ class PostAdjASDF(object):
         self.event_latitude, self.event_longitude, self.event_time = \
             self.origin.latitude, self.origin.longitude, self.origin.time
 
-    def sum_asdf(self):
+    def sum_asdf(self, stations=None):
         """
         Sum different asdf files
+
+        :param stations: if not None, only channels on these
+            stations("NW.STA") are summed
         """
         print("="*30 + "\nSumming asdf files...")
+        vectorized = \
+            (self.param.get("summation_engine", "object") == "vectorized")
         for period, _file_info in self.path["input_file"].iteritems():
             filename = _file_info["asdf_file"]
-            ds = ASDFDataSet(filename, mode='r')
+            ds = ASDFDataSet(filename, mode='r', mpi=False)
             weight_file = _file_info["weight_file"]
             weights = read_json_file(weight_file)
+            if stations is not None:
+                weights = dict(
+                    (_c, _w) for _c, _w in weights.iteritems()
+                    if ".".join(_c.split(".")[:2]) in stations)
             print("-" * 20)
             print("Adding asdf file(%s) using assigned weight_file(%s)"
                   % (filename, weight_file))
             print("Number of channel weights(adjoint sources): %d"
                   % len(weights))
 
-            _misfit = self.add_adjoint_dataset_on_channel_weight(
-                ds, weights)
+            if vectorized:
+                _misfit = self.add_adjoint_dataset_vectorized(ds, weights)
+            else:
+                _misfit = self.add_adjoint_dataset_on_channel_weight(
+                    ds, weights)
             self.misfits[period] = _misfit
 
+        if vectorized:
+            self.adjoint_sources = self.adjoint_stack.to_adjoint_sources()
+
+    def load_and_sum_asdf_parallel(self, nprocs):
+        """
+        Load the period bands concurrently in a process pool, together
+        with the event information, so it takes about the time of the
+        slowest band instead of the sum of all bands. The event
+        consistency is checked on the loaded events and the bands are
+        then summed in order. Workers pass the adjoint source data
+        through temporary .npy files rather than pickles, which avoids
+        one extra copy and the pickle size limit of python 2.
+        """
+        print("="*30 + "\nLoading and summing asdf files with %d processes"
+              % nprocs)
+        tmpdir = tempfile.mkdtemp(prefix="sum_adjoint_")
+        try:
+            jobs = [(period, _info["asdf_file"], _info["weight_file"], None,
+                     os.path.join(tmpdir, "band%d.npy" % _i))
+                    for _i, (period, _info) in
+                    enumerate(sorted(self.path["input_file"].iteritems()))]
+            pool = Pool(processes=min(nprocs, len(jobs)))
+            try:
+                bands = pool.map(load_band_file_to_disk, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+            self.sum_loaded_bands(
+                [(_p, _fn, _events, load_band_data(_band))
+                 for _p, _fn, _events, _band in bands])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def sum_loaded_bands(self, bands, verbose=True):
+        """
+        Check the event information and sum the bands loaded by
+        load_band_file
+        """
+        asdf_events = dict((_fn, _events) for _, _fn, _events, _ in bands)
+        check_events_consistent(asdf_events)
+        self.events = bands[0][2]
+        self.origin = self.events[0].preferred_origin()
+        self.event_latitude, self.event_longitude, self.event_time = \
+            self.origin.latitude, self.origin.longitude, self.origin.time
+
+        for period, asdf_file, _, band in bands:
+            if verbose:
+                print("-" * 20)
+                print("Adding asdf file(%s)" % asdf_file)
+                print("Number of channel weights(adjoint sources): %d"
+                      % len(band["channels"]))
+            self.misfits[period] = self.add_adjoint_band(band,
+                                                         verbose=verbose)
+        self.adjoint_sources = self.adjoint_stack.to_adjoint_sources()
+
+    def sum_asdf_mpi(self):
+        """
+        Stations are split among the MPI ranks. Each rank loads, sums
+        and rotates the adjoint sources of its own stations(with the
+        summation engine and streaming mode in param) and writes them
+        into a shard file. The shards are merged into the output file
+        and the misfits are reduced on rank 0.
+        """
+        comm = _get_mpi_comm()
+        rank, size = comm.rank, comm.size
+
+        if rank == 0:
+            stations = set()
+            for _info in self.path["input_file"].itervalues():
+                weights = read_json_file(_info["weight_file"])
+                stations.update([".".join(_c.split(".")[:2])
+                                 for _c in weights])
+            stations = sorted(stations)
+            print("Number of stations: %d" % len(stations))
+            jobs = [set(stations[_i::size]) for _i in range(size)]
+        else:
+            jobs = None
+        stations = comm.scatter(jobs, root=0)
+
+        outputfile = self.path["output_file"]
+        shard_file = shard_filename(outputfile, rank)
+        # shards left by an earlier run would be merged otherwise
+        smart_remove_file(shard_file, mpi_mode=False)
+        if self.param.get("streaming", False):
+            nadjsrc = self.sum_asdf_streaming(shard_file, stations=stations)
+        else:
+            if self.param.get("summation_engine", "object") == "vectorized":
+                bands = [load_band_file((period, _info["asdf_file"],
+                                         _info["weight_file"], stations))
+                         for period, _info in
+                         sorted(self.path["input_file"].iteritems())]
+                self.sum_loaded_bands(bands, verbose=False)
+            else:
+                self.check_all_event_info()
+                self.sum_asdf(stations=stations)
+
+            if self.param["rotate_flag"]:
+                self.rotate_asdf()
+
+            nadjsrc = len(self.adjoint_sources)
+            if nadjsrc > 0:
+                save_adjoint_to_asdf(
+                    shard_file, self.events, self.adjoint_sources,
+                    self.stations,
+                    batch_write=self.param.get("batch_write", True))
+
+        nadjsrc = tree_reduce(nadjsrc, lambda a, b: a + b, comm=comm)
+        misfits = tree_reduce(self.misfits, merge_misfits, comm=comm)
+        comm.barrier()
+
+        if rank == 0:
+            print("Number of adjoint sources: %d" % nadjsrc)
+            print("Misfit:")
+            pprint(misfits)
+            smart_remove_file(outputfile, mpi_mode=False)
+            if nadjsrc > 0:
+                merge_adjoint_shards(
+                    [shard_filename(outputfile, _i) for _i in range(size)],
+                    outputfile, self.events)
+            else:
+                print("Exit without generate adjoint asdf file since "
+                      "number of adjoint source is 0")
+            self.dump_misfits(outputfile, misfits)
+
     def rotate_asdf(self):
         """
-        Rotate self.adjoint_sources
+        Rotate self.adjoint_sources. If summed by the vectorized engine,
+        all stations are rotated in one batch.
         """
+        if len(self.adjoint_stack) > 0:
+            self.adjoint_stack.rotate_rt_to_ne(
+                self.stations, self.event_latitude, self.event_longitude)
+            self.adjoint_sources = self.adjoint_stack.to_adjoint_sources()
+            return
         self.adjoint_sources = rotate_adjoint_sources(
             self.adjoint_sources, self.stations, self.event_latitude,
             self.event_longitude)
@@ -256,7 +868,8 @@ class PostAdjASDF(object):
                   "number of adjoint source is 0")
             return
         save_adjoint_to_asdf(outputfile, self.events, self.adjoint_sources,
-                             self.stations)
+                             self.stations,
+                             batch_write=self.param.get("batch_write", True))
 
     def _parse_path(self):
         if isinstance(self.path, str):
@@ -276,29 +889,152 @@ class PostAdjASDF(object):
             raise TypeError("Not recognized param: %s" % param)
         return param
 
+    def sum_asdf_streaming(self, outputfile, stations=None):
+        """
+        Sum, rotate and write the adjoint sources station by station.
+        Stations of all the period bands are walked through together in
+        sorted order(a k-way merge of the weight files), so only one
+        station's adjoint sources are kept in memory.
+
+        :param stations: if not None, only channels on these
+            stations("NW.STA") are summed
+        :return: number of adjoint sources written
+        """
+        print("="*30 + "\nSumming asdf files station by station...")
+        periods = sorted(self.path["input_file"].keys())
+        readers = []
+        band_weights = []
+        asdf_events = {}
+        for period in periods:
+            _file_info = self.path["input_file"][period]
+            ds = ASDFDataSet(_file_info["asdf_file"], mode='r', mpi=False)
+            asdf_events[_file_info["asdf_file"]] = ds.events
+            del ds
+            readers.append(AdjointSourceReader(_file_info["asdf_file"]))
+            weights = read_json_file(_file_info["weight_file"])
+            if stations is not None:
+                weights = dict(
+                    (_c, _w) for _c, _w in weights.iteritems()
+                    if ".".join(_c.split(".")[:2]) in stations)
+            band_weights.append(weights)
+            self.misfits[period] = {}
+
+        check_events_consistent(asdf_events)
+        self.events = asdf_events[self.path["input_file"][periods[0]][
+            "asdf_file"]]
+        self.origin = self.events[0].preferred_origin()
+        self.event_latitude, self.event_longitude, self.event_time = \
+            self.origin.latitude, self.origin.longitude, self.origin.time
+
+        # adjoint sources are appended station by station, and the
+        # output file is only created at the first one
+        writer = AdjointFileWriter(
+            outputfile, self.events,
+            batch_write=self.param.get("batch_write", True))
+        nadjsrc = 0
+        merged = heapq.merge(*[iter_station_channels(_w, _i)
+                               for _i, _w in enumerate(band_weights)])
+        try:
+            for station, sta_bands in groupby(merged, key=lambda x: x[0]):
+                self.adjoint_stack = AdjointStack()
+                for _, band_index, channels in sta_bands:
+                    weights = band_weights[band_index]
+                    band = load_adjoint_band(
+                        readers[band_index],
+                        dict((_c, weights[_c]) for _c in channels))
+                    period = periods[band_index]
+                    add_misfits(
+                        self.misfits,
+                        {period: self.add_adjoint_band(band, verbose=False)})
+                if len(self.adjoint_stack) == 0:
+                    continue
+                if self.param["rotate_flag"]:
+                    self.rotate_asdf()
+                adjsrcs = self.adjoint_stack.to_adjoint_sources()
+                writer.write(dump_adjoint_sources(adjsrcs, self.stations))
+                nadjsrc += len(adjsrcs)
+        finally:
+            writer.close()
+
+        for reader in readers:
+            reader.close()
+        self.adjoint_stack = AdjointStack()
+        print("Number of adjoint sources: %d" % nadjsrc)
+        print("Misfit:")
+        pprint(self.misfits)
+        return nadjsrc
+
+    def dump_misfits(self, outputfile, misfits):
+        """
+        write out the misfit summary. If "misfit_db" is given in path,
+        the misfits are also added into the misfit database
+        """
+        misfit_file = outputfile.rstrip("h5") + "adjoint.misfit.json"
+        smart_remove_file(misfit_file, mpi_mode=False)
+        print("Misfit log file: %s" % misfit_file)
+        dump_json(misfits, misfit_file)
+
+        db_file = self.path.get("misfit_db", None)
+        if db_file is None:
+            return
+        event = misfit_file_to_event(misfit_file)
+        print("Add misfits of event(%s) to database: %s" % (event, db_file))
+        conn = connect_misfit_db(db_file)
+        add_event_misfits(conn, event, misfits, source_file=misfit_file,
+                          mtime=os.path.getmtime(misfit_file))
+        conn.close()
+
     def smart_run(self):
 
         self.path = self._parse_path()
         self.param = self._parse_param()
 
+        if is_mpi_env():
+            # validated on rank 0 and the error is broadcast, so all
+            # the ranks exit together instead of waiting in scatter
+            comm = _get_mpi_comm()
+            error = None
+            if comm.rank == 0:
+                try:
+                    validate_path(self.path)
+                    validate_param(self.param)
+                except Exception as err:
+                    error = str(err)
+            error = comm.bcast(error, root=0)
+            if error is not None:
+                raise ValueError(error)
+            self.sum_asdf_mpi()
+            return
+
         validate_path(self.path)
         validate_param(self.param)
 
-        self.check_all_event_info()
+        outputfile = self.path["output_file"]
+        if self.param.get("streaming", False):
+            # bounded memory: summed and written station by station
+            smart_remove_file(outputfile, mpi_mode=False)
+            nadjsrc = self.sum_asdf_streaming(outputfile)
+            if nadjsrc == 0:
+                print("Exit without generate adjoint asdf file since "
+                      "number of adjoint source is 0")
+            self.dump_misfits(outputfile, self.misfits)
+            return
 
-        # sum asdf files
-        self.sum_asdf()
+        nprocs = self.param.get("band_processes", 1)
+        if nprocs > 1:
+            # bands are loaded in parallel and summed by the
+            # vectorized engine
+            self.load_and_sum_asdf_parallel(nprocs)
+        else:
+            self.check_all_event_info()
+            # sum asdf files
+            self.sum_asdf()
 
         # rotate if needed
         if self.param["rotate_flag"]:
             self.rotate_asdf()
 
-        outputfile = self.path["output_file"]
         smart_remove_file(outputfile, mpi_mode=False)
         self.dump_to_asdf(outputfile)
 
-        # write out the misfit summary
-        misfit_file = outputfile.rstrip("h5") + "adjoint.misfit.json"
-        smart_remove_file(misfit_file, mpi_mode=False)
-        print("Misfit log file: %s" % misfit_file)
-        dump_json(self.misfits, misfit_file)
+        self.dump_misfits(outputfile, self.misfits)
@@ -3,7 +3,16 @@ import os
 import argparse
 from pprint import pprint
 
-from utils import read_txt_into_list, dump_json, load_json
+from pypaw.utils import dump_json, read_json_file as load_json
+from pypaw.misfit_db import connect_misfit_db, update_misfit_db, \
+    query_misfits
+
+
+def read_txt_into_list(txtfile):
+    with open(txtfile, 'r') as f:
+        content = f.readlines()
+        eventlist = [line.rstrip() for line in content]
+    return eventlist
 
 
 def sum_adjoint_misfits(filelist):
@@ -22,6 +31,24 @@ def sum_adjoint_misfits(filelist):
     return misfits
 
 
+def sum_adjoint_misfits_from_db(db_file, filelist, eventlist):
+    """
+    Same as sum_adjoint_misfits, but the misfit files are added into
+    the database incrementally(only new or modified files are read)
+    and the summation is done by the database
+    """
+    conn = connect_misfit_db(db_file)
+    nadded = update_misfit_db(conn, dict(zip(eventlist, filelist)))
+    print("Number of events added to database(%s): %d" % (db_file, nadded))
+    misfits = query_misfits(conn, group_by=("period", "component"),
+                            events=eventlist)
+    conn.close()
+
+    print("*"*20 + "\nOverall misfit information:")
+    pprint(misfits)
+    return misfits
+
+
 def construct_filelist(base, eventlist):
     filelist = []
     for event in eventlist:
@@ -35,16 +62,27 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', action='store', dest='event_file', required=True,
                         help="event list file")
+    parser.add_argument('-b', action='store', dest='base',
+                        default="/lustre/atlas/proj-shared/geo111/rawdata/"
+                                "asdf/adjsrc/sum",
+                        help="directory of the misfit json files")
+    parser.add_argument('-d', action='store', dest='db_file', default=None,
+                        help="misfit database file. If provided, misfit "
+                             "files are added incrementally into it")
     args = parser.parse_args()
 
-    base = "/lustre/atlas/proj-shared/geo111/rawdata/asdf/adjsrc/sum"
+    base = args.base
     eventlist = read_txt_into_list(args.event_file)
     print("Number of event: %d" % len(eventlist))
 
     filelist = construct_filelist(base, eventlist)
     print("filelist: %s" % filelist)
 
-    misfits = sum_adjoint_misfits(filelist)
+    if args.db_file is None:
+        misfits = sum_adjoint_misfits(filelist)
+    else:
+        misfits = sum_adjoint_misfits_from_db(args.db_file, filelist,
+                                              eventlist)
 
     outputfile = os.path.join(base, "adjoint_misfit.summary.json")
     print("output json file: %s" % outputfile)
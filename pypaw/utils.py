@@ -162,6 +162,57 @@ def smart_mkdir(dirname, mpi_mode=True, comm=None):
         os.makedirs(dirname)
 
 
+def tree_reduce(obj, merge_func, comm=None):
+    """
+    Reduce python objects from all ranks to rank 0 through a binary
+    tree. At each level, merge_func(obj_a, obj_b) combines the objects
+    from two ranks. The reduced object is only available on rank 0,
+    other ranks return None.
+    """
+    if comm is None:
+        comm = _get_mpi_comm()
+    rank = comm.rank
+    size = comm.size
+    step = 1
+    while step < size:
+        if rank % (2 * step) == 0:
+            partner = rank + step
+            if partner < size:
+                obj = merge_func(obj, comm.recv(source=partner))
+        else:
+            comm.send(obj, dest=rank - step)
+            return None
+        step *= 2
+    return obj
+
+
+def shard_filename(filename, rank):
+    return "%s.shard%05d" % (filename, rank)
+
+
+def merge_json_shards(shard_files, outputfile, remove_shards=True):
+    """
+    Merge json files, each containing a dict, into one json file.
+    Shards are concatenated as text so the content will not be
+    parsed again.
+    """
+    with open(outputfile, 'w') as fh:
+        fh.write("{")
+        first = True
+        for shard in shard_files:
+            with open(shard) as sfh:
+                body = sfh.read().strip()[1:-1].strip()
+            if remove_shards:
+                os.remove(shard)
+            if len(body) == 0:
+                continue
+            if not first:
+                fh.write(",\n")
+            fh.write(body)
+            first = False
+        fh.write("}")
+
+
 def drawProgressBar(percent, user_text="", barLen=20):
     """
     Draw status progress bars in terminal.
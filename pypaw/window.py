@@ -14,13 +14,19 @@ from __future__ import (absolute_import, division, print_function)
 from functools import partial
 import os
 import inspect
+import importlib
 from copy import deepcopy
 import json
+import hashlib
+import heapq
+import cPickle as pickle
+import numpy as np
 import pyflex
 from pytomo3d.window.window import window_on_stream
 from pytomo3d.window.utils import merge_windows, stats_all_windows
 from pytomo3d.window.io import get_json_content, WindowEncoder
-from .utils import smart_mkdir
+from .utils import smart_mkdir, dump_json, tree_reduce, shard_filename
+from .figure import make_plot_payload, dump_plot_payload, render_figures
 from .procbase import ProcASDFBase
 
 
@@ -60,9 +66,55 @@ def load_window_config(param):
     return config_dict, flag_list[0]
 
 
-def write_window_json(results, output_file):
-
-    print("Output window file: %s" % output_file)
+class WindowConfigRegistry(object):
+    """
+    Registry of window params and pyflex.Config objects. In multi-event
+    runs(e.g., pypaw-window_selection_asdf with multiple path files),
+    the window param file is only parsed, validated and built into
+    pyflex.Config once, then reused by the following events in the
+    same process.
+    """
+    def __init__(self):
+        self._params = {}
+        self._configs = {}
+
+    @staticmethod
+    def _param_file_key(param_file):
+        return (os.path.abspath(param_file), os.path.getmtime(param_file))
+
+    def get_param(self, param_file):
+        """ Return the reformed param of the param file, None if missing """
+        return self._params.get(self._param_file_key(param_file))
+
+    def set_param(self, param_file, param):
+        self._params[self._param_file_key(param_file)] = param
+
+    def get_config(self, param):
+        """
+        Return the (config_dict, instrument_merge_flag, user_modules)
+        built from the param. The param will not be modified. A copy
+        of the cached configs is returned, since pyflex could modify
+        the config(e.g., thresholds into arrays of npts) in place.
+        """
+        key = json.dumps(param, sort_keys=True, default=str)
+        if key not in self._configs:
+            param = deepcopy(param)
+            # Ridvan Orsvuran, 2016
+            # take out the user module values
+            user_modules = {}
+            for comp, value in param.iteritems():
+                user_modules[comp] = value.pop("user_module", None)
+            config_dict, instrument_merge_flag = load_window_config(param)
+            self._configs[key] = \
+                (config_dict, instrument_merge_flag, user_modules)
+        return deepcopy(self._configs[key])
+
+
+window_config_registry = WindowConfigRegistry()
+
+
+def get_window_json_content(results):
+    """ Transfer the pyflex windows into json content """
     window_all = {}
     for station, sta_win in results.iteritems():
         if sta_win is None:
@@ -73,7 +125,11 @@ def write_window_json(results, output_file):
             _window = [get_json_content(_i) for _i in trace_win]
             _window_comp[trace_id] = _window
         window_all[station] = _window_comp
+    return window_all
+
 
+def write_window_json(window_all, output_file):
+    """ Write the window json content, sorted by station """
     with open(output_file, 'w') as fh:
         j = json.dumps(window_all, cls=WindowEncoder, sort_keys=True,
                        indent=2, separators=(',', ':'))
@@ -83,12 +139,256 @@ def write_window_json(results, output_file):
             fh.write(j.encode())
 
 
+def iter_window_file(window_file):
+    """
+    Iterate over the stations of a window file written by
+    write_window_json, yielding (station, text) without parsing the
+    windows. The text is the station entry as written(indented, without
+    the trailing comma). With indent=2, station keys are the only lines
+    starting with two spaces and a quote, since json strings have no
+    raw newlines.
+    """
+    station = None
+    lines = []
+    with open(window_file) as fh:
+        for line in fh:
+            if line.startswith('  "'):
+                if station is not None:
+                    yield station, "".join(lines).rstrip().rstrip(",")
+                station = json.loads(line[:line.index('":') + 1])
+                lines = [line]
+            elif station is not None and line.rstrip() != "}":
+                lines.append(line)
+    if station is not None:
+        yield station, "".join(lines).rstrip().rstrip(",")
+
+
+def merge_window_shards(shard_files, output_file, remove_shards=True):
+    """
+    Merge the window files written by each rank(each sorted by station)
+    into output_file, in the same format and station order as a window
+    file written at once. Shards are k-way merged as text, so the
+    windows are not parsed again.
+    """
+    print("Output window file: %s" % output_file)
+    merged = heapq.merge(*[iter_window_file(_f) for _f in shard_files])
+    nstations = 0
+    with open(output_file, 'w') as fh:
+        fh.write("{")
+        for station, text in merged:
+            fh.write("\n" if nstations == 0 else ",\n")
+            fh.write(text)
+            nstations += 1
+        fh.write("\n}" if nstations > 0 else "}")
+    if remove_shards:
+        for shard in shard_files:
+            os.remove(shard)
+    return nstations
+
+
+def stats_local_windows(windows, obsd_tag, synt_tag, instrument_merge_flag,
+                        stats_file):
+    """
+    Window stats(by pytomo3d's stats_all_windows) of the windows on
+    this rank. stats_file is only used as a temporary file.
+    """
+    stats_all_windows(windows, obsd_tag, synt_tag, instrument_merge_flag,
+                      stats_file)
+    with open(stats_file) as fh:
+        stats = json.load(fh)
+    os.remove(stats_file)
+    return stats
+
+
+def merge_window_stats(stats_a, stats_b):
+    """
+    Add up the window stats from two ranks. Counts are summed(also in
+    the nested dicts of each channel), and other values like tags and
+    flags are the same on all ranks and kept.
+    """
+    for key, value in stats_b.iteritems():
+        if key not in stats_a:
+            stats_a[key] = value
+        elif isinstance(value, dict):
+            stats_a[key] = merge_window_stats(stats_a[key], value)
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            stats_a[key] += value
+    return stats_a
+
+
+def hash_traces(stream, component):
+    """
+    Hash the traces of one component in the stream, based on trace id,
+    timing and waveform data
+    """
+    sha = hashlib.sha1()
+    traces = [tr for tr in stream if tr.stats.channel[-1] == component[-1]]
+    for tr in sorted(traces, key=lambda _tr: _tr.id):
+        sha.update(tr.id)
+        sha.update(str(tr.stats.starttime))
+        sha.update(repr(tr.stats.delta))
+        sha.update(np.ascontiguousarray(tr.data).tobytes())
+    return sha.hexdigest()
+
+
+def hash_config(config, user_module=None):
+    """
+    Hash the values of pyflex.Config, together with the user module.
+    Numpy arrays are hashed on their bytes, since their repr is
+    truncated.
+    """
+    sha = hashlib.sha1()
+    for key, value in sorted(config.__dict__.iteritems()):
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            sha.update("%s=%s%s:" % (key, value.dtype, value.shape))
+            sha.update(value.tobytes())
+            sha.update(";")
+        else:
+            sha.update("%s=%r;" % (key, value))
+    sha.update("user_module=%s" % hash_user_module(user_module))
+    return sha.hexdigest()
+
+
+def hash_user_module(user_module):
+    """
+    Hash the source code of the user module(the module or its name),
+    so editing the user module also invalidates the window cache. If
+    the source is not available, the modification time and size of
+    the module file are hashed instead.
+    """
+    if user_module is None:
+        return "None"
+    if isinstance(user_module, basestring):
+        user_module = importlib.import_module(user_module)
+    sha = hashlib.sha1()
+    sha.update("%s;" % user_module.__name__)
+    try:
+        sha.update(inspect.getsource(user_module))
+    except (IOError, TypeError):
+        filename = getattr(user_module, "__file__", None)
+        if filename is not None and os.path.exists(filename):
+            stat = os.stat(filename)
+            sha.update("%r,%r" % (stat.st_mtime, stat.st_size))
+    return sha.hexdigest()
+
+
+def hash_event_and_station(event, station):
+    """
+    Hash the event origin(time and location) and the station
+    coordinates in the inventory, which are also used by pyflex
+    """
+    sha = hashlib.sha1()
+    if event is not None:
+        origin = event.preferred_origin() or event.origins[0]
+        sha.update("origin=%s,%r,%r,%r;" % (
+            origin.time, origin.latitude, origin.longitude, origin.depth))
+    if station is not None:
+        for nw in station:
+            for sta in nw:
+                sha.update("%s.%s=%r,%r,%r;" % (
+                    nw.code, sta.code, sta.latitude, sta.longitude,
+                    sta.elevation))
+                for chan in sta:
+                    sha.update("%s.%s=%r,%r,%r,%r;" % (
+                        chan.location_code, chan.code, chan.latitude,
+                        chan.longitude, chan.elevation, chan.depth))
+    return sha.hexdigest()
+
+
+def _window_cache_file(cache_dir, station, component):
+    return os.path.join(cache_dir, "%s.%s.windows.pkl" % (station, component))
+
+
+def load_cached_windows(cache_dir, station, component, key):
+    """
+    Load the cached windows of one (station, component). Return None if
+    no cache found or the cache key does not match.
+    """
+    cache_file = _window_cache_file(cache_dir, station, component)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as fh:
+            content = pickle.load(fh)
+    except Exception as err:
+        print("Failed to load window cache(%s) due to: %s"
+              % (cache_file, err))
+        return None
+    if content["key"] != key:
+        return None
+    return content["windows"]
+
+
+def dump_cached_windows(cache_dir, station, component, key, windows):
+    """
+    Dump windows of one (station, component) into the cache
+    """
+    cache_file = _window_cache_file(cache_dir, station, component)
+    with open(cache_file, 'wb') as fh:
+        pickle.dump({"key": key, "windows": windows}, fh,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def window_on_stream_with_cache(observed, synthetic, config_dict, station,
+                                station_name, cache_dir, user_modules=None,
+                                **kwargs):
+    """
+    Window selection with a per-(station, component) cache. The cache
+    key is made of the observed and synthetic waveform hashes, the
+    config values, the event origin and the station coordinates, so
+    only components with changed inputs will be selected again.
+    """
+    if user_modules is None:
+        user_modules = {}
+
+    windows = {}
+    keys = {}
+    missing_config = {}
+    geo_key = hash_event_and_station(kwargs.get("event"), station)
+    for comp, config in config_dict.iteritems():
+        keys[comp] = "%s-%s-%s-%s" % (
+            hash_traces(observed, comp), hash_traces(synthetic, comp),
+            hash_config(config, user_modules.get(comp)), geo_key)
+        cached = load_cached_windows(cache_dir, station_name, comp,
+                                     keys[comp])
+        if cached is None:
+            missing_config[comp] = config
+        else:
+            windows.update(cached)
+
+    if len(missing_config) == 0:
+        return windows
+
+    new_windows = window_on_stream(
+        observed, synthetic, missing_config, station=station,
+        user_modules=user_modules, **kwargs)
+    for comp in missing_config:
+        comp_windows = dict(
+            (trace_id, trace_win)
+            for trace_id, trace_win in new_windows.iteritems()
+            if trace_id[-1] == comp[-1])
+        dump_cached_windows(cache_dir, station_name, comp, keys[comp],
+                            comp_windows)
+        windows.update(comp_windows)
+
+    return windows
+
+
 def window_wrapper(obsd_station_group, synt_station_group, config_dict=None,
                    obsd_tag=None, synt_tag=None, user_modules=None,
                    event=None, figure_mode=False, figure_dir=None,
-                   _verbose=False):
+                   figure_deferred=True, cache_dir=None,
+                   instrument_merge_flag=False, _verbose=False):
     """
-    Wrapper for asdf I/O
+    Wrapper for asdf I/O. If cache_dir is provided, the windows
+    will be cached(and reused) on each station and component. If
+    figure_mode is True, the plot payload will be dumped to figure_dir
+    and the figure will be rendered later(or if figure_deferred is
+    False, pyflex figures are plotted during the selection, only for
+    components not found in the cache). If instrument_merge_flag
+    is True, multiple instruments are merged on this station.
     """
     # Make sure everything thats required is there.
     if not hasattr(synt_station_group, "StationXML"):
@@ -104,12 +404,41 @@ def window_wrapper(obsd_station_group, synt_station_group, config_dict=None,
     inv = synt_station_group.StationXML
     observed = getattr(obsd_station_group, obsd_tag)
     synthetic = getattr(synt_station_group, synt_tag)
-
-    return window_on_stream(
-        observed, synthetic, config_dict, station=inv,
-        event=event, user_modules=user_modules,
-        figure_mode=figure_mode, figure_dir=figure_dir,
-        _verbose=_verbose)
+    # pyflex may modify the config in place, so each station starts
+    # from a clean copy
+    config_dict = deepcopy(config_dict)
+
+    inline_figure = figure_mode and not figure_deferred
+    if cache_dir is not None:
+        windows = window_on_stream_with_cache(
+            observed, synthetic, config_dict, inv,
+            obsd_station_group._station_name, cache_dir,
+            user_modules=user_modules, event=event,
+            figure_mode=inline_figure, figure_dir=figure_dir,
+            _verbose=_verbose)
+    else:
+        windows = window_on_stream(
+            observed, synthetic, config_dict, station=inv,
+            event=event, user_modules=user_modules,
+            figure_mode=inline_figure, figure_dir=figure_dir,
+            _verbose=_verbose)
+
+    if instrument_merge_flag and windows:
+        # merge multiple instruments inside the worker, so nothing
+        # is left to be merged after all stations are processed
+        station = obsd_station_group._station_name
+        windows = merge_windows({station: windows}).get(station)
+
+    if figure_mode and figure_deferred and windows:
+        # figures are rendered after all stations are processed
+        window_json = dict(
+            (trace_id, [get_json_content(_w) for _w in trace_win])
+            for trace_id, trace_win in windows.iteritems())
+        payload = make_plot_payload(observed, synthetic, window_json)
+        dump_plot_payload(figure_dir, obsd_station_group._station_name,
+                          payload)
+
+    return windows
 
 
 class WindowASDF(ProcASDFBase):
@@ -120,6 +449,11 @@ class WindowASDF(ProcASDFBase):
                               debug=debug)
 
     def _parse_param(self):
+        if isinstance(self.param, str):
+            results = window_config_registry.get_param(self.param)
+            if results is not None:
+                return results
+
         myrank = self.comm.Get_rank()
         param = self._parse_yaml(self.param)
 
@@ -139,6 +473,8 @@ class WindowASDF(ProcASDFBase):
                           % (k, results[_comp][k], v))
                 results[_comp][k] = v
 
+        if isinstance(self.param, str):
+            window_config_registry.set_param(self.param, results)
         return results
 
     def _validate_path(self, path):
@@ -172,41 +508,52 @@ class WindowASDF(ProcASDFBase):
         synt_tag = path["synt_tag"]
         figure_mode = path["figure_mode"]
         figure_dir = output_dir
+        # if False, the pyflex figures are plotted during the selection
+        figure_deferred = path.get("figure_deferred", True)
+        # the window cache is optional
+        cache_dir = path.get("window_cache_dir", None)
+        if cache_dir is not None:
+            smart_mkdir(cache_dir, mpi_mode=self.mpi_mode,
+                        comm=self.comm)
 
         obsd_ds = self.load_asdf(obsd_file)
         synt_ds = self.load_asdf(synt_file)
 
         event = obsd_ds.events[0]
 
-        # Ridvan Orsvuran, 2016
-        # take out the user module values
-        user_modules = {}
-        for key, value in param.iteritems():
-            user_modules[key] = value.pop("user_module", None)
-
-        config_dict, instrument_merge_flag = load_window_config(param)
+        config_dict, instrument_merge_flag, user_modules = \
+            window_config_registry.get_config(param)
 
         winfunc = partial(window_wrapper, config_dict=config_dict,
                           obsd_tag=obsd_tag, synt_tag=synt_tag,
                           user_modules=user_modules,
                           event=event, figure_mode=figure_mode,
-                          figure_dir=figure_dir, _verbose=self._verbose)
-
-        windows = \
-            obsd_ds.process_two_files(synt_ds, winfunc)
+                          figure_dir=figure_dir,
+                          figure_deferred=figure_deferred,
+                          cache_dir=cache_dir,
+                          instrument_merge_flag=instrument_merge_flag,
+                          _verbose=self._verbose)
+
+        # results are kept on each rank rather than gathered to rank 0
+        windows = self.process_two_files_no_gather(obsd_ds, synt_ds, winfunc)
+
+        if figure_mode and figure_deferred:
+            render_figures(figure_dir, comm=self.comm)
+
+        # each rank writes its own shard(sorted by station) and the
+        # window stats are reduced to rank 0
+        write_window_json(get_window_json_content(windows),
+                          shard_filename(output_file, self.rank))
+        stats_logfile = os.path.join(output_dir, "windows.stats.json")
+        stats = stats_local_windows(
+            windows, obsd_tag, synt_tag, instrument_merge_flag,
+            shard_filename(stats_logfile, self.rank))
+        stats = tree_reduce(stats, merge_window_stats, comm=self.comm)
+        self.comm.barrier()
 
         if self.rank == 0:
-            if instrument_merge_flag:
-                # merge multiple instruments
-                results = merge_windows(windows)
-            else:
-                # nothing is done
-                results = windows
-
-            stats_logfile = os.path.join(output_dir, "windows.stats.json")
-            # stats windows on rand 0
-            stats_all_windows(results, obsd_tag, synt_tag,
-                              instrument_merge_flag,
-                              stats_logfile)
-
-            write_window_json(results, output_file)
+            print("Window stats file: %s" % stats_logfile)
+            dump_json(stats, stats_logfile)
+            shard_files = [shard_filename(output_file, _i)
+                           for _i in range(self.comm.Get_size())]
+            merge_window_shards(shard_files, output_file)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Window counts of window files. Counts could be cached in a cache
+directory(as "<basename>.<path hash>.counts.json"), so the window
+weighting and window counting tools don't need to parse the same
+window file again. The cache is validated by the modification time
+and size of the window file, and by its md5 hash if the modification
+time changed. Nothing is written if no cache directory is given.
+
+The counts could also be scanned directly from the raw text of the
+window file(fast=True), without building the nested dicts of all the
+windows.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import os
+import re
+import json
+import hashlib
+
+
+COUNTS_SUFFIX = ".counts.json"
+
+# channel id(as "NET.STA.LOC.CHA") followed by its list of windows
+CHANNEL_KEY = re.compile(
+    r'"([^"\s.]*\.[^"\s.]*\.[^"\s.]*\.[^"\s.]+)"\s*:\s*\[')
+# each window has one and only one "left_index"
+WINDOW_KEY = re.compile(r'"left_index"\s*:')
+
+
+def count_receiver_windows(windows):
+    """
+    Count windows of each channel in one window file, grouped by
+    component(channel code). Channels without windows are kept, with
+    zero counts. Stations of None are skipped.
+
+    :return: (rec_wcounts, cat_wcounts), as {comp: {chan_id: nwins}}
+        and {comp: nwins}
+    """
+    rec_wcounts = {}
+    cat_wcounts = {}
+    for sta_win in windows.itervalues():
+        if sta_win is None:
+            continue
+        for chan_id, chan_win in sta_win.iteritems():
+            nwins = len(chan_win)
+            comp = chan_id.split(".")[-1]
+            rec_wcounts.setdefault(comp, {})[chan_id] = nwins
+            cat_wcounts[comp] = cat_wcounts.get(comp, 0) + nwins
+    return rec_wcounts, cat_wcounts
+
+
+def scan_receiver_windows(raw):
+    """
+    Same as count_receiver_windows, but scanned from the raw text of
+    the window file. Windows of one channel are the "left_index" keys
+    between its channel id and the next one.
+    """
+    rec_wcounts = {}
+    cat_wcounts = {}
+    channels = list(CHANNEL_KEY.finditer(raw))
+    for idx, match in enumerate(channels):
+        if idx + 1 < len(channels):
+            endpos = channels[idx + 1].start()
+        else:
+            endpos = len(raw)
+        nwins = len(WINDOW_KEY.findall(raw, match.end(), endpos))
+        chan_id = match.group(1)
+        comp = chan_id.split(".")[-1]
+        rec_wcounts.setdefault(comp, {})[chan_id] = nwins
+        cat_wcounts[comp] = cat_wcounts.get(comp, 0) + nwins
+    return rec_wcounts, cat_wcounts
+
+
+def drop_empty_channels(rec_wcounts, cat_wcounts):
+    """
+    Remove the channels(and components) without windows, which are
+    not weighted
+    """
+    nonempty_rec_wcounts = {}
+    for comp, comp_wcounts in rec_wcounts.iteritems():
+        for chan_id, nwins in comp_wcounts.iteritems():
+            if nwins > 0:
+                nonempty_rec_wcounts.setdefault(comp, {})[chan_id] = nwins
+    nonempty_cat_wcounts = dict((comp, nwins) for comp, nwins in
+                                cat_wcounts.iteritems() if nwins > 0)
+    return nonempty_rec_wcounts, nonempty_cat_wcounts
+
+
+def counts_filename(window_file, cache_dir):
+    """
+    Cache file of one window file. The hash of the absolute path is
+    in the name, since window files of different events usually share
+    the same basename.
+    """
+    window_file = os.path.abspath(window_file)
+    tag = hashlib.md5(window_file).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s.%s%s" % (
+        os.path.basename(window_file), tag, COUNTS_SUFFIX))
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def _load_counts_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def _dump_counts_cache(cache_file, content):
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file, 'w') as fh:
+            json.dump(content, fh, sort_keys=True)
+    except (IOError, OSError) as err:
+        # cache is optional, e.g., created by another process in the
+        # meantime or not writable
+        print("Failed to write window counts cache(%s): %s"
+              % (cache_file, err))
+
+
+def load_window_counts(window_file, cache_dir=None, fast=False,
+                       skip_empty=False):
+    """
+    Get the window counts of one window file
+
+    :param cache_dir: directory of the cached window counts. Counts
+        are not cached if None.
+    :param fast: scan the window counts from the raw text, instead of
+        loading the json file
+    :param skip_empty: remove channels without windows, see
+        drop_empty_channels
+
+    :return: dict with keys "rec_wcounts"({comp: {chan_id: nwins}})
+        and "cat_wcounts"({comp: nwins})
+    """
+    counts = None
+    cache = None
+    if cache_dir is not None:
+        cache_file = counts_filename(window_file, cache_dir)
+        signature = file_signature(window_file)
+        cache = _load_counts_cache(cache_file)
+        if cache is not None and cache["size"] == signature["size"] and \
+                cache["mtime"] == signature["mtime"]:
+            counts = cache["counts"]
+
+    if counts is None:
+        with open(window_file, 'rb') as fh:
+            raw = fh.read()
+        md5 = hashlib.md5(raw).hexdigest()
+        if cache is not None and cache["md5"] == md5:
+            # touched but not modified
+            counts = cache["counts"]
+        else:
+            if fast:
+                rec_wcounts, cat_wcounts = scan_receiver_windows(raw)
+            else:
+                rec_wcounts, cat_wcounts = \
+                    count_receiver_windows(json.loads(raw))
+            counts = {"rec_wcounts": rec_wcounts,
+                      "cat_wcounts": cat_wcounts}
+        if cache_dir is not None:
+            content = {"mtime": signature["mtime"],
+                       "size": signature["size"], "md5": md5,
+                       "counts": counts}
+            _dump_counts_cache(cache_file, content)
+
+    if skip_empty:
+        rec_wcounts, cat_wcounts = drop_empty_channels(
+            counts["rec_wcounts"], counts["cat_wcounts"])
+        counts = {"rec_wcounts": rec_wcounts, "cat_wcounts": cat_wcounts}
+    return counts
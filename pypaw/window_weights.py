@@ -16,6 +16,9 @@ So this program is station weighting + category weighting combined.
 The source weighting could be determined later when the kernels
 are summed together.
 
+With the vectorized engine, window counts could be cached in the
+directory path["counts_cache_dir"](optional, see pypaw.window_counts).
+
 :copyright:
     Wenjie Lei (lei@princeton.edu), 2016
 :license:
@@ -29,6 +32,8 @@ from collections import defaultdict
 from copy import deepcopy
 import numpy as np
 import logging
+from pypaw.spatial_weights import load_station_locations, \
+    calculate_receiver_weights_on_files
 import matplotlib.pyplot as plt
 plt.switch_backend('agg')  # NOQA
 
@@ -121,6 +126,11 @@ def validate_param(param):
             print("Key(%s) not in param['receiver_weighting']" % key)
             err = 1
 
+    engine = param['receiver_weighting'].get("engine", "pytomo3d")
+    if engine not in ["pytomo3d", "vectorized"]:
+        print("Unrecognized receiver weighting engine: %s" % engine)
+        err = 1
+
     if err != 0:
         raise ValueError("Error in param file. Please double check!")
 
@@ -312,6 +322,10 @@ class WindowWeight(object):
         logger_block("Receiver Weighting")
 
         weighting_param = self.param["receiver_weighting"]
+        vectorized = (weighting_param.get("engine", "pytomo3d") !=
+                      "pytomo3d")
+        # station locations loaded once, shared by period bands
+        locations = {}
 
         input_info = self.path["input"]
         nperiods = len(input_info)
@@ -324,8 +338,18 @@ class WindowWeight(object):
             _path_info = deepcopy(period_info)
             _path_info.pop("asdf_file", None)
             # the _results contains three components data
-            _results = calculate_receiver_weights_interface(
-                self.src_info, _path_info, weighting_param)
+            if vectorized:
+                station_file = _path_info["station_file"]
+                if station_file not in locations:
+                    locations[station_file] = \
+                        load_station_locations(station_file)
+                _results = calculate_receiver_weights_on_files(
+                    _path_info, weighting_param,
+                    locations=locations[station_file],
+                    counts_cache_dir=self.path.get("counts_cache_dir"))
+            else:
+                _results = calculate_receiver_weights_interface(
+                    self.src_info, _path_info, weighting_param)
 
             self.rec_weights[period] = _results["rec_weights"]
             self.rec_wcounts[period] = _results["rec_wcounts"]
@@ -16,6 +16,9 @@ Finally, it combines the all and generate the final weightings.
 So to run this script, you need to provide information for all
 the sources, and your database should stay fixed afterwards.
 
+Window counts could be cached in the directory
+path["counts_cache_dir"](optional, see pypaw.window_counts).
+
 :copyright:
     Wenjie Lei (lei@princeton.edu), 2016
 :license:
@@ -26,10 +29,14 @@ from __future__ import print_function, division, absolute_import
 
 import os
 from collections import defaultdict
+from multiprocessing import Pool
 import time
 import numpy as np
 import logging
 from pprint import pprint
+from pypaw.spatial_weights import load_station_locations, \
+    calculate_receiver_weights_on_files, calculate_source_weights_on_arrays
+from pypaw.window_counts import load_window_counts
 import matplotlib.pyplot as plt
 plt.switch_backend('agg')  # NOQA
 
@@ -37,7 +44,7 @@ import obspy
 from pytomo3d.source.source_weights import assign_source_to_points, \
     calculate_source_weights_on_location
 from pytomo3d.window.window_weights import \
-    calculate_receiver_weights_interface, calculate_receiver_window_counts
+    calculate_receiver_weights_interface
 from pypaw.bins.utils import load_json, dump_json, load_yaml
 
 
@@ -122,6 +129,11 @@ def validate_param(param):
     _missing_keys(keys, param["receiver_weighting"])
     _missing_keys(keys, param["source_weighting"])
 
+    for key in ["receiver_weighting", "source_weighting"]:
+        engine = param[key].get("engine", "pytomo3d")
+        if engine not in ["pytomo3d", "vectorized"]:
+            raise ValueError("Unrecognized %s engine: %s" % (key, engine))
+
 
 def extract_receiver_locations(station_file, windows):
     """
@@ -176,17 +188,37 @@ def normalize_source_weights(points):
     return weights
 
 
+def calculate_source_weights_vectorized(src_info, param, logdir):
+    """
+    Source weights by pypaw.spatial_weights, on the epicenter
+    locations. Engine is given by param["engine"]
+    """
+    events = sorted(src_info.keys())
+    origins = [src_info[_e][0].preferred_origin() for _e in events]
+    weights, ref_distance, cond_numb = calculate_source_weights_on_arrays(
+        np.array([_o.latitude for _o in origins]),
+        np.array([_o.longitude for _o in origins]), param,
+        figname=os.path.join(logdir, "source_weights.smart_scan.png"))
+    print("The sum of source weights: %f" % np.sum(weights))
+    src_weights = dict((_e, float(_w)) for _e, _w in zip(events, weights))
+    return src_weights, ref_distance, cond_numb
+
+
 def calculate_source_weights(src_info, param, logdir):
     logger_block("Source Weighting")
-    points = assign_source_to_points(src_info)
+    if param.get("engine", "pytomo3d") != "pytomo3d":
+        src_weights, ref_distance, cond_numb = \
+            calculate_source_weights_vectorized(src_info, param, logdir)
+    else:
+        points = assign_source_to_points(src_info)
 
-    ref_distance = -1.0
-    cond_numb = -1.0
-    if param["flag"]:
-        ref_distance, cond_numb = calculate_source_weights_on_location(
-            points, param["search_ratio"], param["plot"], logdir)
+        ref_distance = -1.0
+        cond_numb = -1.0
+        if param["flag"]:
+            ref_distance, cond_numb = calculate_source_weights_on_location(
+                points, param["search_ratio"], param["plot"], logdir)
 
-    src_weights = normalize_source_weights(points)
+        src_weights = normalize_source_weights(points)
 
     # generate log file
     log_content = \
@@ -200,13 +232,18 @@ def calculate_source_weights(src_info, param, logdir):
     return src_weights
 
 
-def calculate_receiver_weights_asdf_one_event(cat, event_info, param):
+def calculate_receiver_weights_asdf_one_event(cat, event_info, param,
+                                              counts_cache_dir=None):
     results = {}
     nperiods = len(event_info)
     period_idx = 0
     origin = cat[0].preferred_origin()
     src_info = {"latitude": origin.latitude, "longitude": origin.longitude,
                 "depth_in_m": origin.depth}
+    vectorized = (param.get("engine", "pytomo3d") != "pytomo3d")
+    if vectorized:
+        # station locations are shared by all period bands
+        locations = load_station_locations(event_info["stationfile"])
     # determine receiver weightings for each asdf file
     for period, period_info in event_info["period_info"].iteritems():
         period_idx += 1
@@ -216,8 +253,13 @@ def calculate_receiver_weights_asdf_one_event(cat, event_info, param):
                       "window_file": period_info["window_file"],
                       "output_file": period_info["output_file"]}
         # the _results contains three components data
-        results[period] = calculate_receiver_weights_interface(
-            src_info, _path_info, param)
+        if vectorized:
+            results[period] = calculate_receiver_weights_on_files(
+                _path_info, param, locations=locations,
+                counts_cache_dir=counts_cache_dir)
+        else:
+            results[period] = calculate_receiver_weights_interface(
+                src_info, _path_info, param)
 
         outputdir = os.path.dirname(period_info["output_file"])
         receiver_weights_file = os.path.join(
@@ -228,7 +270,15 @@ def calculate_receiver_weights_asdf_one_event(cat, event_info, param):
     return results
 
 
-def get_event_category_window_counts(path_info):
+def _receiver_weights_one_event(args):
+    """ process pool worker, args as (event, cat, event_info, param,
+    counts_cache_dir) """
+    ev, cat, event_info, param, counts_cache_dir = args
+    return ev, calculate_receiver_weights_asdf_one_event(
+        cat, event_info, param, counts_cache_dir=counts_cache_dir)
+
+
+def get_event_category_window_counts(path_info, counts_cache_dir=None):
     cat_wcounts = {}
     print("Reading window files to get events cateogry window counts")
     t1 = time.time()
@@ -236,18 +286,22 @@ def get_event_category_window_counts(path_info):
     for ev, evinfo in path_info.iteritems():
         cat_wcounts[ev] = {}
         for pb, pbinfo in evinfo["period_info"].iteritems():
-            winfile = pbinfo["window_file"]
-            windows = load_json(winfile)
-            _, _wcounts = calculate_receiver_window_counts(windows)
-            cat_wcounts[ev][pb] = _wcounts
+            # with the counts cached, the window file is only parsed
+            # once for all the tools
+            counts = load_window_counts(pbinfo["window_file"],
+                                        cache_dir=counts_cache_dir,
+                                        skip_empty=True)
+            cat_wcounts[ev][pb] = counts["cat_wcounts"]
     t2 = time.time()
     print("Category weighting I/O time: %.2f sec" % (t2 - t1))
     return cat_wcounts
 
 
-def calculate_category_weights(src_weights, path_info, param, logdir):
+def calculate_category_weights(src_weights, path_info, param, logdir,
+                               counts_cache_dir=None):
 
-    cat_wcounts = get_event_category_window_counts(path_info)
+    cat_wcounts = get_event_category_window_counts(
+        path_info, counts_cache_dir=counts_cache_dir)
     # category weight = 1 / (N_c * \sum_{s} w_{s} N_{sc})
     sumv = {}
     for ev in cat_wcounts:
@@ -472,6 +526,11 @@ class WindowWeight(object):
         weighting_param = self.param["receiver_weighting"]
 
         input_info = self.path["input"]
+        nprocs = self.param.get("nprocs", 1)
+        if nprocs > 1:
+            self.calculate_receiver_weights_parallel(nprocs)
+            return
+
         nevents = len(input_info)
         idx = 0
         for ev, evinfo in input_info.iteritems():
@@ -480,10 +539,35 @@ class WindowWeight(object):
                         % (idx, nevents, ev) + "=" * 15)
             cat = self.src_info[ev]
             _results = calculate_receiver_weights_asdf_one_event(
-                cat, evinfo, weighting_param)
+                cat, evinfo, weighting_param,
+                counts_cache_dir=self.path.get("counts_cache_dir"))
 
             self.attach_event_receiver_weights(ev, _results)
 
+    def calculate_receiver_weights_parallel(self, nprocs):
+        """
+        Events are independent in receiver weighting, so they are
+        distributed to a process pool. Results are attached when each
+        event is done.
+        """
+        weighting_param = self.param["receiver_weighting"]
+        input_info = self.path["input"]
+        nevents = len(input_info)
+        logger.info("Receiver weighting on %d events with %d processes"
+                    % (nevents, nprocs))
+        counts_cache_dir = self.path.get("counts_cache_dir")
+        jobs = [(ev, self.src_info[ev], input_info[ev], weighting_param,
+                 counts_cache_dir) for ev in sorted(input_info)]
+        pool = Pool(processes=nprocs)
+        try:
+            for idx, (ev, _results) in enumerate(
+                    pool.imap_unordered(_receiver_weights_one_event, jobs)):
+                logger.info("[%d/%d]Event done: %s" % (idx + 1, nevents, ev))
+                self.attach_event_receiver_weights(ev, _results)
+        finally:
+            pool.close()
+            pool.join()
+
     def attach_event_receiver_weights(self, ev, results):
         self.rec_weights[ev] = {}
         self.cat_wcounts[ev] = {}
@@ -542,7 +626,8 @@ class WindowWeight(object):
         logger_block("Category Weighting")
         self.cat_weights = calculate_category_weights(
             self.src_weights, self.path["input"],
-            self.param["category_weighting"], logdir)
+            self.param["category_weighting"], logdir,
+            counts_cache_dir=self.path.get("counts_cache_dir"))
 
         # calculate receiver weights
         self.calculate_receiver_weights_asdf()
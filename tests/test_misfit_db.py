@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the cross-event misfit database.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import json
+import pytest
+
+pytest.importorskip("pyasdf")
+from pypaw.misfit_db import connect_misfit_db, add_event_misfits, \
+    update_misfit_db, query_misfits, list_events  # NOQA
+from pypaw.sum_adjoint_misfit import sum_adjoint_misfits, \
+    sum_adjoint_misfits_from_db  # NOQA
+
+
+MISFITS = {
+    "C201001122153A": {
+        "17_40": {"BHZ": {"misfit": 1.0, "raw_misfit": 2.0},
+                  "BHT": {"misfit": 0.5, "raw_misfit": 1.5}},
+        "40_100": {"BHZ": {"misfit": 0.25, "raw_misfit": 0.5}}},
+    "C201002271434A": {
+        "17_40": {"BHZ": {"misfit": 2.0, "raw_misfit": 3.0}},
+        "40_100": {"BHZ": {"misfit": 0.75, "raw_misfit": 1.0},
+                   "BHR": {"misfit": 0.125, "raw_misfit": 0.25}}}}
+
+
+def _write_misfit_files(dirname, misfits):
+    filelist = {}
+    for event, content in misfits.iteritems():
+        filename = os.path.join(dirname, "%s.adjoint.misfit.json" % event)
+        with open(filename, 'w') as fh:
+            json.dump(content, fh)
+        filelist[event] = filename
+    return filelist
+
+
+def test_add_and_query_misfits():
+    conn = connect_misfit_db(":memory:")
+    for event, content in MISFITS.iteritems():
+        add_event_misfits(conn, event, content)
+    assert list_events(conn) == sorted(MISFITS)
+
+    assert query_misfits(conn, group_by=()) == pytest.approx(4.625)
+    assert query_misfits(conn, group_by=("period", "component")) == {
+        "17_40": {"BHZ": 3.0, "BHT": 0.5},
+        "40_100": {"BHZ": 1.0, "BHR": 0.125}}
+    assert query_misfits(conn, group_by=("event",)) == {
+        "C201001122153A": 1.75, "C201002271434A": 2.875}
+    assert query_misfits(conn, group_by=("component",),
+                         events=["C201001122153A"]) == \
+        {"BHZ": 1.25, "BHT": 0.5}
+    with pytest.raises(ValueError):
+        query_misfits(conn, group_by=("station",))
+
+    # adding the same event again replaces its records
+    add_event_misfits(conn, "C201001122153A",
+                      {"17_40": {"BHZ": {"misfit": 4.0}}})
+    assert query_misfits(conn, group_by=("event",)) == {
+        "C201001122153A": 4.0, "C201002271434A": 2.875}
+    conn.close()
+
+
+def test_update_misfit_db_reads_new_or_modified_files(tmpdir):
+    filelist = _write_misfit_files(str(tmpdir), MISFITS)
+    conn = connect_misfit_db(os.path.join(str(tmpdir), "misfits.db"))
+    assert update_misfit_db(conn, filelist) == 2
+    # nothing changed
+    assert update_misfit_db(conn, filelist) == 0
+
+    # modify one file, with a different modification time
+    event = "C201001122153A"
+    with open(filelist[event], 'w') as fh:
+        json.dump({"17_40": {"BHZ": {"misfit": 3.0, "raw_misfit": 4.0}}},
+                  fh)
+    mtime = os.path.getmtime(filelist[event]) + 10
+    os.utime(filelist[event], (mtime, mtime))
+    assert update_misfit_db(conn, filelist) == 1
+    assert query_misfits(conn, group_by=("event", "period")) == {
+        "C201001122153A": {"17_40": 3.0},
+        "C201002271434A": {"17_40": 2.0, "40_100": 0.875}}
+
+    # missing files are skipped
+    filelist["C999999999999A"] = os.path.join(str(tmpdir), "missing.json")
+    assert update_misfit_db(conn, filelist) == 0
+    conn.close()
+
+
+def test_sum_from_db_same_as_json_files(tmpdir):
+    filelist = _write_misfit_files(str(tmpdir), MISFITS)
+    eventlist = sorted(filelist)
+    files = [filelist[_e] for _e in eventlist]
+    db_file = os.path.join(str(tmpdir), "misfits.db")
+
+    expected = sum_adjoint_misfits(files)
+    for _ in range(2):
+        # the second time, the events are already in the database
+        results = sum_adjoint_misfits_from_db(db_file, files, eventlist)
+        assert sorted(results) == sorted(expected)
+        for period, period_misfits in expected.iteritems():
+            assert sorted(results[period]) == sorted(period_misfits)
+            for comp, value in period_misfits.iteritems():
+                assert results[period][comp] == pytest.approx(value)
+
+    # only the events asked are summed
+    results = sum_adjoint_misfits_from_db(db_file, files[:1], eventlist[:1])
+    assert results == sum_adjoint_misfits(files[:1])
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the DPSS taper cache.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import numpy.testing as npt
+import pytest
+
+dpss = pytest.importorskip("pyadjoint.dpss")
+from pypaw.multitaper import DPSSCache, dpss_cache_installed, \
+    merge_dpss_cache_stats, PYADJOINT_DPSS_MODULES  # NOQA
+
+
+def test_dpss_cache_same_as_pyadjoint():
+    cache = DPSSCache()
+    tapers, eigens = cache.dpss_windows(200, 2.5, 4)
+    expected_tapers, expected_eigens = dpss.dpss_windows(200, 2.5, 4)
+    npt.assert_allclose(tapers, expected_tapers)
+    npt.assert_allclose(eigens, expected_eigens)
+
+    # copies are returned, so the cached tapers are not modified
+    tapers[:] = 0.0
+    tapers, _ = cache.dpss_windows(200, 2.5, 4)
+    npt.assert_allclose(tapers, expected_tapers)
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_dpss_cache_lru():
+    cache = DPSSCache(maxsize=2)
+    cache.dpss_windows(100, 2.5, 4)
+    cache.dpss_windows(120, 2.5, 4)
+    cache.dpss_windows(100, 2.5, 4)
+    # the least recently used(npts=120) is dropped
+    cache.dpss_windows(140, 2.5, 4)
+    cache.dpss_windows(100, 2.5, 4)
+    assert cache.stats() == {"hits": 2, "misses": 3, "size": 2}
+    cache.dpss_windows(120, 2.5, 4)
+    assert cache.stats() == {"hits": 2, "misses": 4, "size": 2}
+
+    assert merge_dpss_cache_stats(cache.stats(), cache.stats()) == \
+        {"hits": 4, "misses": 8, "size": 4}
+
+
+def test_dpss_cache_installed():
+    module = pytest.importorskip(PYADJOINT_DPSS_MODULES[0])
+    original = module.dpss_windows
+    with dpss_cache_installed() as cache:
+        module.dpss_windows(200, 2.5, 4)
+        module.dpss_windows(200, 2.5, 4)
+        assert cache.stats()["hits"] == 1
+    assert module.dpss_windows is original
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the vectorized geographical weighting.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import json
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+pytest.importorskip("pyasdf")
+from pypaw.spatial_weights import DistanceWeighting, \
+    calculate_receiver_weights_on_files  # NOQA
+
+
+STATIONS = {
+    "II.AAK": [42.64, 74.49, 1645.0, 30.0],
+    "II.ABKT": [37.93, 58.12, 678.0, 7.0],
+    "II.ALE": [82.50, -62.35, 60.0, 0.0],
+    "IU.ANMO": [34.95, -106.46, 1820.0, 100.0],
+    "IU.CCM": [38.06, -91.24, 222.0, 0.0],
+    "IU.COLA": [64.87, -147.86, 200.0, 0.0],
+    "IU.HRV": [42.51, -71.56, 200.0, 0.0],
+    "IU.SNZO": [-41.31, 174.70, 120.0, 0.0],
+    "IU.TUC": [32.31, -110.78, 909.0, 0.0],
+    "IU.WCI": [38.23, -86.29, 210.0, 0.0]}
+
+
+def _windows():
+    """ 1 to 3 windows on each channel, with a few channels missing """
+    windows = {}
+    for idx, sta in enumerate(sorted(STATIONS)):
+        windows[sta] = {}
+        for comp in ["BHZ", "BHR", "BHT"]:
+            nwins = (idx + len(comp) + ord(comp[-1])) % 4
+            windows[sta]["%s..%s" % (sta, comp)] = \
+                [{"left_index": 100 * _i, "right_index": 100 * _i + 50}
+                 for _i in range(nwins)]
+    return windows
+
+
+def _brute_force_scan(latitudes, longitudes, search_ratio, start=0.1,
+                      gap=0.3, drop_ratio=0.95):
+    """ the same scan, one pair at a time """
+    npoints = len(latitudes)
+    lat = np.deg2rad(latitudes)
+    lon = np.deg2rad(longitudes)
+    dists = np.zeros((npoints, npoints))
+    for i in range(npoints):
+        for j in range(npoints):
+            cos_d = np.sin(lat[i]) * np.sin(lat[j]) + \
+                np.cos(lat[i]) * np.cos(lat[j]) * np.cos(lon[i] - lon[j])
+            dists[i, j] = np.rad2deg(np.arccos(np.clip(cos_d, -1.0, 1.0)))
+
+    def _weights(ref_dist):
+        return np.array([1.0 / sum(np.exp(-(dists[i, j] / ref_dist) ** 2)
+                                   for j in range(npoints))
+                         for i in range(npoints)])
+
+    ref_dists = []
+    cond_nums = []
+    ref_dist = start
+    while ref_dist <= 180.0:
+        weights = _weights(ref_dist)
+        ref_dists.append(ref_dist)
+        cond_nums.append(max(weights) / min(weights))
+        if cond_nums[-1] < drop_ratio * max(cond_nums):
+            break
+        ref_dist += gap
+    peak = int(np.argmax(cond_nums))
+    target = search_ratio * cond_nums[peak]
+    idx = int(np.argmin(np.abs(np.array(cond_nums[:peak + 1]) - target)))
+    return ref_dists[idx], _weights(ref_dists[idx])
+
+
+def _locations():
+    stations = sorted(STATIONS)
+    return np.array([STATIONS[_s][0] for _s in stations]), \
+        np.array([STATIONS[_s][1] for _s in stations])
+
+
+def test_scan_same_as_brute_force():
+    lats, lons = _locations()
+    ref_dist, _, weights, _, _ = DistanceWeighting(lats, lons).scan(0.35)
+    expected_dist, expected_weights = _brute_force_scan(lats, lons, 0.35)
+    npt.assert_allclose(ref_dist, expected_dist)
+    npt.assert_allclose(weights, expected_weights, rtol=1e-8)
+
+
+def test_scan_on_fixed_points():
+    # three points on the equator(at longitude 0, 10 and 90) and one
+    # at 30N on longitude 0
+    weighting = DistanceWeighting([0.0, 0.0, 0.0, 30.0],
+                                  [0.0, 10.0, 90.0, 0.0])
+    ref_dist, cond_num, weights, ref_dists, cond_nums = \
+        weighting.scan(0.5)
+    # the condition number peaks(2.4421) at 41.2 degree, and the one
+    # closest to half of the peak before it is at 8.2 degree
+    npt.assert_allclose(ref_dists[np.argmax(cond_nums)], 41.2)
+    npt.assert_allclose(np.max(cond_nums), 2.442118915, rtol=1e-8)
+    npt.assert_allclose(ref_dist, 8.2)
+    npt.assert_allclose(cond_num, 1.226003863, rtol=1e-8)
+    npt.assert_allclose(weights, [0.8156581152, 0.8156588729, 1.0,
+                                  0.9999980624], rtol=1e-8)
+
+
+def test_receiver_weights_same_as_pytomo3d(tmpdir):
+    window_weights = pytest.importorskip("pytomo3d.window.window_weights")
+    station_file = os.path.join(str(tmpdir), "stations.json")
+    window_file = os.path.join(str(tmpdir), "windows.json")
+    with open(station_file, 'w') as fh:
+        json.dump(STATIONS, fh)
+    with open(window_file, 'w') as fh:
+        json.dump(_windows(), fh)
+    path_info = {"station_file": station_file, "window_file": window_file,
+                 "output_file": os.path.join(str(tmpdir), "weights.json")}
+    param = {"flag": True, "plot": False, "search_ratio": 0.35}
+    src_info = {"latitude": 35.2, "longitude": -117.6, "depth_in_m": 8000.0}
+
+    results = calculate_receiver_weights_on_files(path_info, param)
+    expected = window_weights.calculate_receiver_weights_interface(
+        src_info, path_info, param)
+
+    assert results["cat_wcounts"] == expected["cat_wcounts"]
+    assert results["rec_wcounts"] == expected["rec_wcounts"]
+    assert sorted(results["rec_weights"]) == sorted(expected["rec_weights"])
+    for comp, comp_weights in expected["rec_weights"].iteritems():
+        assert sorted(results["rec_weights"][comp]) == sorted(comp_weights)
+        for chan_id, weight in comp_weights.iteritems():
+            npt.assert_allclose(results["rec_weights"][comp][chan_id],
+                                weight, rtol=1e-5)
+        npt.assert_allclose(results["rec_ref_dists"][comp],
+                            expected["rec_ref_dists"][comp])
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the vectorized adjoint source summation.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+from copy import deepcopy
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+pytest.importorskip("pytomo3d")
+from obspy import UTCDateTime  # NOQA
+from pyadjoint import AdjointSource  # NOQA
+from pytomo3d.adjoint.sum_adjoint import dump_adjsrc, \
+    rotate_adjoint_sources  # NOQA
+import pypaw.sum_adjoint  # NOQA
+from pypaw.sum_adjoint import AdjointStack, PostAdjASDF, add_misfits, \
+    merge_misfits, load_band_file_to_disk, load_band_data, \
+    validate_param  # NOQA
+
+
+EVENT_LATITUDE = 35.2
+EVENT_LONGITUDE = -117.6
+
+STATIONS = {
+    "II_AAK": {"network": "II", "station": "AAK", "location": "00",
+               "latitude": 42.64, "longitude": 74.49,
+               "elevation_in_m": 1645.0, "depth_in_m": 30.0},
+    "IU_ANMO": {"network": "IU", "station": "ANMO", "location": "00",
+                "latitude": 34.95, "longitude": -106.46,
+                "elevation_in_m": 1820.0, "depth_in_m": 100.0},
+    "IU_SNZO": {"network": "IU", "station": "SNZO", "location": "00",
+                "latitude": -41.31, "longitude": 174.70,
+                "elevation_in_m": 120.0, "depth_in_m": 0.0}}
+
+
+def _adjsrc(sta_tag, comp, data, misfit=1.0):
+    network, station = sta_tag.split("_")
+    return AdjointSource(
+        "multitaper_misfit", misfit=misfit, dt=0.5, min_period=27.0,
+        max_period=60.0, component=comp, adjoint_source=data,
+        network=network, station=station, location="00",
+        starttime=UTCDateTime(2016, 1, 1))
+
+
+def _all_adjsrcs():
+    np.random.seed(0)
+    adjsrcs = {}
+    for sta_tag in sorted(STATIONS):
+        for comp in ["MXZ", "MXR", "MXT"]:
+            adjsrcs["%s_%s" % (sta_tag, comp)] = \
+                _adjsrc(sta_tag, comp, np.random.randn(100))
+    return adjsrcs
+
+
+class _Data(np.ndarray):
+    """ array which also has the "value" of h5py datasets """
+    @property
+    def value(self):
+        return np.asarray(self)
+
+
+class _AuxiliaryDataItem(object):
+    def __init__(self, data, parameters):
+        self.data = np.asarray(data).view(_Data)
+        self.parameters = parameters
+
+
+class _DataSet(object):
+    """ ASDFDataSet with only the adjoint sources """
+    def __init__(self, adjsrcs):
+        group = {}
+        for adj in adjsrcs:
+            sta_tag = "%s_%s" % (adj.network, adj.station)
+            adj_array, adj_path, parameters = dump_adjsrc(
+                adj, STATIONS[sta_tag])
+            group[adj_path] = _AuxiliaryDataItem(adj_array, parameters)
+
+        class _AuxiliaryData(object):
+            AdjointSources = group
+
+        self.auxiliary_data = _AuxiliaryData()
+
+
+def _bands():
+    """ two period bands, with one channel in the second band of a
+    different npts, which should be skipped """
+    np.random.seed(1)
+    bands = []
+    weights = []
+    for period_idx in range(2):
+        adjsrcs = []
+        band_weights = {}
+        for sta_tag in sorted(STATIONS):
+            for comp in ["Z", "R", "T"]:
+                npts = 100
+                if period_idx == 1 and sta_tag == "IU_ANMO" and comp == "T":
+                    npts = 120
+                adjsrcs.append(_adjsrc(sta_tag, "MX" + comp,
+                                       np.random.randn(npts),
+                                       misfit=np.random.rand()))
+                channel = "%s.00.BH%s" % (sta_tag.replace("_", "."), comp)
+                band_weights[channel] = {"weight": np.random.rand()}
+        bands.append(_DataSet(adjsrcs))
+        weights.append(band_weights)
+    return bands, weights
+
+
+def _sum_bands(engine):
+    bands, weights = _bands()
+    summer = PostAdjASDF({}, {"rotate_flag": False,
+                              "summation_engine": engine})
+    for idx, (ds, band_weights) in enumerate(zip(bands, weights)):
+        if engine == "vectorized":
+            misfits = summer.add_adjoint_dataset_vectorized(ds, band_weights)
+        else:
+            misfits = summer.add_adjoint_dataset_on_channel_weight(
+                ds, band_weights)
+        summer.misfits["band%d" % idx] = misfits
+    if engine == "vectorized":
+        summer.adjoint_sources = summer.adjoint_stack.to_adjoint_sources()
+    return summer
+
+
+def test_vectorized_engine_same_as_object_engine():
+    expected = _sum_bands("object")
+    results = _sum_bands("vectorized")
+
+    assert sorted(results.adjoint_sources) == \
+        sorted(expected.adjoint_sources)
+    for adj_id, adj in expected.adjoint_sources.iteritems():
+        new_adj = results.adjoint_sources[adj_id]
+        npt.assert_allclose(new_adj.adjoint_source, adj.adjoint_source)
+        npt.assert_allclose(new_adj.misfit, adj.misfit)
+        assert new_adj.component == adj.component
+        assert new_adj.starttime == adj.starttime
+
+    # misfits of the skipped channel are still counted, as the object
+    # engine does
+    assert sorted(results.misfits) == sorted(expected.misfits)
+    for period, period_misfits in expected.misfits.iteritems():
+        assert sorted(results.misfits[period]) == sorted(period_misfits)
+        for comp, comp_misfits in period_misfits.iteritems():
+            for key, value in comp_misfits.iteritems():
+                npt.assert_allclose(results.misfits[period][comp][key],
+                                    value)
+    assert sorted(results.stations) == sorted(expected.stations)
+
+
+def test_rotate_rt_to_ne_same_as_pytomo3d():
+    adjsrcs = _all_adjsrcs()
+    adj_ids = sorted(adjsrcs)
+    data = [adjsrcs[_id].adjoint_source for _id in adj_ids]
+
+    stack = AdjointStack()
+    empty = []
+    for adj_id in adj_ids:
+        adj = deepcopy(adjsrcs[adj_id])
+        adj.adjoint_source = np.zeros(0)
+        empty.append(adj)
+    stack.add(adj_ids, empty, data, np.ones(len(adj_ids)))
+    stack.rotate_rt_to_ne(STATIONS, EVENT_LATITUDE, EVENT_LONGITUDE)
+    results = stack.to_adjoint_sources()
+
+    expected = rotate_adjoint_sources(
+        deepcopy(adjsrcs), STATIONS, EVENT_LATITUDE, EVENT_LONGITUDE)
+
+    assert sorted(results.keys()) == sorted(expected.keys())
+    for adj_id, adj in expected.iteritems():
+        assert results[adj_id].component == adj.component
+        npt.assert_allclose(results[adj_id].adjoint_source,
+                            adj.adjoint_source, atol=1e-12)
+
+
+def test_add_and_merge_misfits():
+    misfits = {"17_40": {"MXZ": {"misfit": 1.0, "nwindows": 2}}}
+    part = {"17_40": {"MXZ": {"misfit": 0.5, "nwindows": 1},
+                      "MXT": {"misfit": 2.0, "nwindows": 3}},
+            "40_100": {"MXZ": {"misfit": 1.5, "nwindows": 1}}}
+    merged = merge_misfits(misfits, part)
+    # merge leaves both parts untouched
+    assert misfits["17_40"]["MXZ"] == {"misfit": 1.0, "nwindows": 2}
+    assert merged == {"17_40": {"MXZ": {"misfit": 1.5, "nwindows": 3},
+                                "MXT": {"misfit": 2.0, "nwindows": 3}},
+                      "40_100": {"MXZ": {"misfit": 1.5, "nwindows": 1}}}
+
+    add_misfits(misfits, part)
+    assert misfits == merged
+    # new components are copied, not shared with the added part
+    misfits["17_40"]["MXT"]["nwindows"] += 1
+    assert part["17_40"]["MXT"]["nwindows"] == 3
+
+
+def test_band_data_through_disk(tmpdir, monkeypatch):
+    data = [np.arange(10, dtype=np.float64), np.ones(12), np.zeros(0)]
+
+    def _load_band_file(args):
+        return args[0], args[1], "events", \
+            {"channels": ["II.AAK.00.BHZ", "II.AAK.00.BHR", "II.AAK.00.BHT"],
+             "data": [np.copy(_d) for _d in data]}
+
+    monkeypatch.setattr(pypaw.sum_adjoint, "load_band_file", _load_band_file)
+    data_file = os.path.join(str(tmpdir), "band0.npy")
+    period, asdf_file, events, band = load_band_file_to_disk(
+        ("17_40", "17_40.h5", "17_40.weights.json", None, data_file))
+    assert (period, asdf_file, events) == ("17_40", "17_40.h5", "events")
+    # the data is left out of the returned band
+    assert band["data"] is None
+
+    band = load_band_data(band)
+    assert len(band["data"]) == len(data)
+    for array, expected in zip(band["data"], data):
+        npt.assert_allclose(array, expected)
+
+
+def test_band_processes_requires_vectorized_engine():
+    validate_param({"rotate_flag": True, "band_processes": 4,
+                    "summation_engine": "vectorized"})
+    with pytest.raises(ValueError):
+        validate_param({"rotate_flag": True, "band_processes": 4})
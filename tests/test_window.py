@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the window cache keys and window file merging.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import sys
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("pyflex")
+import pypaw.window  # NOQA
+from pypaw.window import WindowConfigRegistry, hash_user_module, merge_window_shards, \
+    merge_window_stats, write_window_json  # NOQA
+
+
+def test_hash_user_module_changes_with_source(tmpdir):
+    module_file = os.path.join(str(tmpdir), "pypaw_test_user_module.py")
+    with open(module_file, 'w') as fh:
+        fh.write("def generate_user_levels(config, station, event, "
+                 "obsd, synt):\n    return 1.0\n")
+    sys.path.insert(0, str(tmpdir))
+    try:
+        key = hash_user_module("pypaw_test_user_module")
+        assert hash_user_module("pypaw_test_user_module") == key
+
+        with open(module_file, 'w') as fh:
+            fh.write("def generate_user_levels(config, station, event, "
+                     "obsd, synt):\n    return 2.0 * 1.0\n")
+        assert hash_user_module("pypaw_test_user_module") != key
+    finally:
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop("pypaw_test_user_module", None)
+
+    assert hash_user_module(None) == "None"
+
+
+def _window(left, right):
+    return {"left_index": left, "right_index": right, "cc_shift": 1,
+            "phase_arrivals": [{"name": "S", "time": 12.5}]}
+
+
+def test_merge_window_shards_same_as_one_file(tmpdir):
+    windows = {
+        "II.AAK": {"II.AAK.00.BHZ": [_window(1, 20), _window(30, 50)],
+                   "II.AAK.00.BHR": []},
+        "IU.ANMO": {"IU.ANMO.00.BHT": [_window(5, 15)]},
+        "IU.HRV": {},
+        "IU.SNZO": {"IU.SNZO.00.BHZ": [_window(2, 8)]}}
+    shards = [["IU.ANMO", "II.AAK"], [], ["IU.SNZO", "IU.HRV"]]
+    shard_files = []
+    for idx, stations in enumerate(shards):
+        shard_file = os.path.join(str(tmpdir), "windows.json.shard%d" % idx)
+        write_window_json(dict((_s, windows[_s]) for _s in stations),
+                          shard_file)
+        shard_files.append(shard_file)
+
+    output_file = os.path.join(str(tmpdir), "windows.json")
+    assert merge_window_shards(shard_files, output_file) == 4
+    assert not any(os.path.exists(_f) for _f in shard_files)
+
+    expected_file = os.path.join(str(tmpdir), "expected.json")
+    write_window_json(windows, expected_file)
+    with open(output_file) as fh, open(expected_file) as efh:
+        assert fh.read() == efh.read()
+
+    # no windows at all
+    empty_file = os.path.join(str(tmpdir), "empty.json.shard0")
+    write_window_json({}, empty_file)
+    merge_window_shards([empty_file], output_file)
+    with open(output_file) as fh:
+        assert json.load(fh) == {}
+
+
+def test_merge_window_stats():
+    stats_a = {"obsd_tag": "proc_obsd", "instrument_merge_flag": True,
+               "stations": 2, "stations_with_windows": 1,
+               "BHZ": {"window": 3, "traces": 2, "traces_with_windows": 1}}
+    stats_b = {"obsd_tag": "proc_obsd", "instrument_merge_flag": True,
+               "stations": 3, "stations_with_windows": 3,
+               "BHZ": {"window": 2, "traces": 3, "traces_with_windows": 2},
+               "BHT": {"window": 4, "traces": 3, "traces_with_windows": 3}}
+    assert merge_window_stats(stats_a, stats_b) == {
+        "obsd_tag": "proc_obsd", "instrument_merge_flag": True,
+        "stations": 5, "stations_with_windows": 4,
+        "BHZ": {"window": 5, "traces": 5, "traces_with_windows": 3},
+        "BHT": {"window": 4, "traces": 3, "traces_with_windows": 3}}
+
+
+class _Config(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_config_registry_returns_copies(monkeypatch):
+    def _load_window_config(param):
+        return dict((_c, _Config(**_v)) for _c, _v in param.iteritems()), \
+            False
+
+    monkeypatch.setattr(pypaw.window, "load_window_config",
+                        _load_window_config)
+    registry = WindowConfigRegistry()
+    param = {"BHZ": {"stalta_waterlevel": 0.1,
+                     "user_module": "raise_after_rayleigh"}}
+
+    config_dict, merge_flag, user_modules = registry.get_config(param)
+    assert user_modules == {"BHZ": "raise_after_rayleigh"}
+    assert "user_module" in param["BHZ"]
+    # as pyflex does on one event
+    config_dict["BHZ"].stalta_waterlevel = 0.1 * np.ones(100)
+
+    config_dict, _, _ = registry.get_config(param)
+    assert config_dict["BHZ"].stalta_waterlevel == 0.1
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the window counts of window files.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import json
+import pytest
+
+pytest.importorskip("pyflex")
+from pypaw.window import write_window_json  # NOQA
+from pypaw.window_counts import count_receiver_windows, \
+    scan_receiver_windows, load_window_counts  # NOQA
+
+
+def _window(chan_id, idx):
+    """ window content as written by get_json_content """
+    return {"left_index": 100 * idx, "right_index": 100 * idx + 50,
+            "center_index": 100 * idx + 25, "channel_id": chan_id,
+            "channel_id_2": chan_id.replace("BH", "MX"),
+            "max_cc_value": 0.95, "cc_shift_in_samples": 2,
+            "cc_shift_in_seconds": 0.3, "dlnA": -0.1, "dt": 0.15,
+            "min_period": 27.0, "window_weight": 0.9,
+            "time_of_first_sample": "2010-01-12T21:53:10.000000Z",
+            "absolute_starttime": "2010-01-12T21:55:25.000000Z",
+            "absolute_endtime": "2010-01-12T21:57:40.000000Z",
+            "relative_starttime": 15.0, "relative_endtime": 22.5,
+            "phase_arrivals": [{"name": "P", "time": 120.5}]}
+
+
+def _windows():
+    """ windows of a few stations, with channels without windows and
+    a station of None """
+    windows = {"IU.ANMO": None}
+    nwins = {"II.AAK": {"00.BHZ": 2, "00.BHR": 0, "00.BHT": 1},
+             "IU.CCM": {".BHZ": 3, ".BHR": 1, ".BHT": 0},
+             "IU.HRV": {"00.BHZ": 0, "00.BHR": 0, "00.BHT": 0}}
+    for sta, sta_nwins in nwins.iteritems():
+        windows[sta] = {}
+        for chan, chan_nwins in sta_nwins.iteritems():
+            chan_id = "%s.%s" % (sta, chan)
+            windows[sta][chan_id] = [_window(chan_id, _i)
+                                     for _i in range(chan_nwins)]
+    return windows
+
+
+def test_scan_same_as_json_on_window_file(tmpdir):
+    window_file = os.path.join(str(tmpdir), "windows.json")
+    write_window_json(_windows(), window_file)
+    with open(window_file) as fh:
+        raw = fh.read()
+    with open(window_file) as fh:
+        expected = count_receiver_windows(json.load(fh))
+
+    assert scan_receiver_windows(raw) == expected
+    rec_wcounts, cat_wcounts = expected
+    # channels without windows are kept
+    assert rec_wcounts["BHR"] == {"II.AAK.00.BHR": 0, "IU.CCM..BHR": 1,
+                                  "IU.HRV.00.BHR": 0}
+    assert cat_wcounts == {"BHZ": 5, "BHR": 1, "BHT": 1}
+
+
+def test_load_window_counts_cache(tmpdir):
+    datadir = os.path.join(str(tmpdir), "data")
+    cachedir = os.path.join(str(tmpdir), "cache")
+    os.mkdir(datadir)
+    window_file = os.path.join(datadir, "windows.json")
+    windows = _windows()
+    write_window_json(windows, window_file)
+    expected = count_receiver_windows(windows)
+
+    counts = load_window_counts(window_file)
+    assert (counts["rec_wcounts"], counts["cat_wcounts"]) == expected
+    # nothing is written without a cache directory
+    assert os.listdir(datadir) == ["windows.json"]
+
+    for fast in [False, True]:
+        counts = load_window_counts(window_file, cache_dir=cachedir,
+                                    fast=fast)
+        assert (counts["rec_wcounts"], counts["cat_wcounts"]) == expected
+    assert len(os.listdir(cachedir)) == 1
+    assert os.listdir(datadir) == ["windows.json"]
+
+    # the cache is updated once the window file is modified
+    windows["IU.HRV"]["IU.HRV.00.BHT"] = [_window("IU.HRV.00.BHT", 0)]
+    write_window_json(windows, window_file)
+    mtime = os.path.getmtime(window_file) + 10
+    os.utime(window_file, (mtime, mtime))
+    counts = load_window_counts(window_file, cache_dir=cachedir,
+                                skip_empty=True)
+    assert counts["cat_wcounts"] == {"BHZ": 5, "BHR": 1, "BHT": 2}
+    assert counts["rec_wcounts"]["BHT"] == {"II.AAK.00.BHT": 1,
+                                            "IU.HRV.00.BHT": 1}
+    assert counts["rec_wcounts"]["BHR"] == {"IU.CCM..BHR": 1}